@@ -0,0 +1,61 @@
+"""
+Measures UserDatabase read throughput with a growing number of concurrent callers.
+
+Usage: python -m benchmarks.db_concurrency [--users N] [--reads N] [--threads 1,2,4,8]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from database.db import UserDatabase
+
+
+def populate(db, users):
+    with db.transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (chat_id, cookies, username, password) VALUES (?, ?, ?, ?)",
+            ((chat_id, f"PHPSESSID=s{chat_id}; session=c{chat_id}", f"user{chat_id}", "secret")
+             for chat_id in range(users))
+        )
+
+
+def run_readers(db, threads, reads, users):
+    barrier = threading.Barrier(threads + 1)
+
+    def reader(offset):
+        barrier.wait()
+        for i in range(reads):
+            db.get_cookies((offset + i * 7919) % users)
+
+    workers = [threading.Thread(target=reader, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return threads * reads / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--reads", type=int, default=20000, help="reads per thread")
+    parser.add_argument("--threads", default="1,2,4,8")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = UserDatabase(os.path.join(tmp, "bench.db"))
+        populate(db, args.users)
+        baseline = None
+        for threads in map(int, args.threads.split(",")):
+            throughput = run_readers(db, threads, args.reads, args.users)
+            baseline = baseline or throughput
+            print(f"{threads:>3} threads: {throughput:>10.0f} reads/s ({throughput / baseline:.2f}x)")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
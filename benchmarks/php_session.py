@@ -0,0 +1,143 @@
+"""
+Compares the original regex user id extraction with laundry.php_session (uncached and memoized)
+on identity cookies, and checks the decoder against a corpus of fuzzed serialized values:
+random nested values must round-trip, and truncated or corrupted ones must raise PHPSerializeError.
+
+Usage: python -m benchmarks.php_session [--cookies 1000] [--repeat 20] [--fuzz 5000] [--seed 0]
+                                        [--write-corpus corpus.txt]
+"""
+import argparse
+import math
+import random
+import re
+import string
+import time
+import urllib.parse
+
+from laundry.php_session import PHPSerializeError, decode_identity_cookie, serialize, unserialize
+
+
+def regex_user_id(cookie_value: str):
+    """The user id extraction as it was before laundry.php_session."""
+    decoded_cookie = urllib.parse.unquote(cookie_value)
+    try:
+        hash_prefix, session_data = decoded_cookie.split(":", 1)
+    except ValueError:
+        return None
+    session_data_clean = re.sub(r"^\d+:", "", session_data, count=1)
+    matches = re.findall(
+        r"i:(\d+);(?:s:(\d+):\"([^\"]*)\"|i:(\d+);|a:(\d+):\{\})",
+        session_data_clean
+    )
+    for match in matches:
+        if int(match[0]) == 0:
+            return match[2] if match[1] else int(match[3]) if match[3] else None
+    return None
+
+
+def decoder_user_id(cookie_value: str):
+    return decode_identity_cookie.__wrapped__(cookie_value).get(0)
+
+
+def cached_user_id(cookie_value: str):
+    return decode_identity_cookie(cookie_value).get(0)
+
+
+def identity_cookies(count, seed=0):
+    rng = random.Random(seed)
+    cookies = []
+    for index in range(count):
+        identity = [str(100000 + index), f"user{index}@example.com", 2592000, {"role": "student", "room": index}]
+        payload = serialize(identity)
+        digest = "".join(rng.choice("0123456789abcdef") for _ in range(40))
+        cookies.append(urllib.parse.quote(digest + payload))
+    return cookies
+
+
+def random_value(rng, depth=0):
+    kinds = ["null", "bool", "int", "float", "string"] + (["array"] * 2 if depth < 4 else [])
+    kind = rng.choice(kinds)
+    if kind == "null":
+        return None
+    if kind == "bool":
+        return rng.random() < 0.5
+    if kind == "int":
+        return rng.randint(-2 ** 63, 2 ** 63 - 1)
+    if kind == "float":
+        return rng.choice([rng.uniform(-1e6, 1e6), math.inf, -math.inf, 0.0, 1e-300])
+    if kind == "string":
+        alphabet = string.ascii_letters + string.digits + string.punctuation + " " + "\"';:{}ąęłńóśźżĄĘŁŃÓŚŹŻ€"
+        return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 24)))
+    keys = [rng.choice([rng.randint(-5, 50), "".join(rng.choice("abc\";:{}") for _ in range(3))])
+            for _ in range(rng.randint(0, 5))]
+    return {key: random_value(rng, depth + 1) for key in keys}
+
+
+def mutate(rng, data: str) -> str:
+    operation = rng.choice(["truncate", "flip", "length", "append"])
+    if operation == "truncate" or not data:
+        return data[:rng.randrange(len(data))] if data else data
+    if operation == "flip":
+        position = rng.randrange(len(data))
+        return data[:position] + rng.choice("\"{};:asidbN0-9") + data[position + 1:]
+    if operation == "length":
+        return re.sub(r"s:(\d+):", lambda match: f"s:{int(match[1]) + rng.choice([-1, 1])}:", data, count=1)
+    return data + rng.choice(["N;", "}", ";", "x"])
+
+
+def fuzz(count, seed=0, corpus=None):
+    """Returns (round trips, mutations raising PHPSerializeError, mutations still valid)."""
+    rng = random.Random(seed)
+    rejected = accepted = 0
+    for _ in range(count):
+        value = random_value(rng)
+        data = serialize(value)
+        if unserialize(data) != value:
+            raise AssertionError(f"Round trip failed for {data!r}")
+        mutated = mutate(rng, data)
+        if corpus is not None:
+            corpus.write(data + "\n" + mutated + "\n")
+        try:
+            unserialize(mutated)
+            accepted += 1
+        except PHPSerializeError:
+            rejected += 1
+    return count, rejected, accepted
+
+
+def measure(func, cookies, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for cookie in cookies:
+            func(cookie)
+    return (time.perf_counter() - started) / (repeat * len(cookies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cookies", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--fuzz", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--write-corpus", help="also write the fuzzed strings to this file, one per line")
+    args = parser.parse_args()
+
+    cookies = identity_cookies(args.cookies, args.seed)
+    for cookie in cookies:
+        if regex_user_id(cookie) != cached_user_id(cookie):
+            raise AssertionError(f"User ids differ for {cookie!r}")
+
+    print(f"{'path':<10} {'us/cookie':>10}")
+    for name, func in (("regex", regex_user_id), ("decoder", decoder_user_id), ("cached", cached_user_id)):
+        print(f"{name:<10} {measure(func, cookies, args.repeat) * 1e6:>10.2f}")
+
+    if args.write_corpus:
+        with open(args.write_corpus, "w", encoding="utf-8") as corpus:
+            total, rejected, accepted = fuzz(args.fuzz, args.seed, corpus)
+    else:
+        total, rejected, accepted = fuzz(args.fuzz, args.seed)
+    print(f"\nfuzz: {total} round trips, {rejected} mutations rejected, {accepted} mutations still valid")
+
+
+if __name__ == "__main__":
+    main()
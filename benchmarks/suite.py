@@ -0,0 +1,342 @@
+"""
+Runs the hot path microbenchmarks and compares them with the stored baseline: database reads and
+writes from 1 and N threads, the refresh scheduler query at growing user counts, cookie parsing and
+user id extraction, transaction summing (in memory and through get_transactions_sum against a stubbed
+pralnie.org) and the top-up keyboard. Everything runs offline on a temporary database.
+
+Each case is timed over several rounds, and every round is divided by the time of a fixed
+calibration workload run just before it, so that the machine speeding up or slowing down during
+the run cancels out. The median of these ratios is compared with the baseline: a case fails when it
+is more than its threshold (a fraction, --threshold by default) slower, and the exit status is then 1.
+Baselines depend on the machine, so record them with --save-baseline on the machine that runs the
+comparison. --quick runs fewer iterations as a smoke test and is not compared with the baseline.
+
+Usage: python -m benchmarks.suite [--filter db.] [--threshold 0.25] [--quick]
+                                  [--baseline benchmarks/baseline.json] [--save-baseline]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Keep the upstream limits out of the measurements and any unstubbed request off the network
+os.environ.setdefault("PRALNIE_BASE_URL", "http://pralnie.invalid/index.php")
+os.environ.setdefault("UPSTREAM_MAX_CONCURRENT", "1000")
+os.environ.setdefault("UPSTREAM_RATE_PER_SECOND", "1000000")
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_THRESHOLD = 0.25
+# Multi-threaded cases depend on scheduling and are noisier
+THREADED_THRESHOLD = 0.5
+
+USER_COUNTS = (1_000, 10_000, 100_000)
+# Timed rounds per case, the median is reported
+REPEAT = 11
+
+# Ratios of each timed round of the current case to the calibration sample taken before it
+_round_ratios = []
+HISTORY_SIZE = 10_000
+
+
+class Case:
+    """A named benchmark: run(context) returns the seconds taken per operation."""
+
+    def __init__(self, name, run, threshold=None):
+        self.name = name
+        self.run = run
+        self.threshold = threshold
+
+
+def calibration_sample() -> float:
+    """Times a fixed pure-Python workload, showing how fast the machine runs right now."""
+    started = time.perf_counter()
+    for _ in range(2):
+        sum(i * i for i in range(20000))
+        sorted(str(i) for i in range(2000))
+    return time.perf_counter() - started
+
+
+def record_round(seconds: float, calibration: float):
+    _round_ratios.append(seconds / calibration)
+
+
+def time_per_op(func, number, repeat=REPEAT):
+    """Median time per call of func over repeat rounds of number calls, after an untimed warm-up round."""
+    for _ in range(number):
+        func()
+    timings = []
+    for _ in range(repeat):
+        calibration = calibration_sample()
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+        record_round(timings[-1], calibration)
+    return statistics.median(timings)
+
+
+def threaded_time_per_op(func, threads, number, repeat=REPEAT // 2):
+    """Median wall time per call over repeat rounds in which threads threads each call func(i) number times."""
+    def round_time():
+        barrier = threading.Barrier(threads + 1)
+
+        def worker(offset):
+            barrier.wait()
+            for i in range(number):
+                func(offset + i * 7919)
+
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        for thread in workers:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        return (time.perf_counter() - started) / (threads * number)
+
+    round_time()
+    timings = []
+    for _ in range(repeat):
+        calibration = calibration_sample()
+        timings.append(round_time())
+        record_round(timings[-1], calibration)
+    return statistics.median(timings)
+
+
+class Context:
+    """State shared by the cases: a temporary database grown to the requested number of users."""
+
+    def __init__(self, directory, quick):
+        from database.db import UserDatabase
+        self.db = UserDatabase(os.path.join(directory, "bench.db"))
+        self.quick = quick
+        self.users = 0
+        self.now = time.time()
+        self.grow(USER_COUNTS[0])
+
+    def scaled(self, count):
+        return max(1, count // 10) if self.quick else count
+
+    def grow(self, users):
+        """Adds users up to the given count, with cookie expirations spread over the next two days."""
+        from benchmarks.php_session import identity_cookies
+        if users <= self.users:
+            return
+        cookies = self.cookies = f"PHPSESSID=s; identity={identity_cookies(1)[0]}"
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO users (chat_id, cookies, cookie_expires_at, username, password) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((chat_id, cookies, int(self.now + chat_id * 172800 / users),
+                  f"user{chat_id}", "secret")
+                 for chat_id in range(self.users, users))
+            )
+        self.users = users
+
+
+def db_cases():
+    def get_cookies(ctx):
+        return time_per_op(lambda: ctx.db.get_cookies(ctx.users // 2), ctx.scaled(5000))
+
+    def get_user(ctx):
+        return time_per_op(lambda: ctx.db.get_user(ctx.users // 2), ctx.scaled(5000))
+
+    def set_cookies(ctx):
+        return time_per_op(lambda: ctx.db.set_cookies(ctx.users // 2, "PHPSESSID=x"), ctx.scaled(500))
+
+    def threaded_get_cookies(ctx):
+        return threaded_time_per_op(lambda i: ctx.db.get_cookies(i % ctx.users), 4, ctx.scaled(5000))
+
+    def threaded_set_cookies(ctx):
+        return threaded_time_per_op(lambda i: ctx.db.set_cookies(i % ctx.users, "PHPSESSID=x"), 4, ctx.scaled(250))
+
+    cases = [
+        Case("db.get_cookies[1 thread]", get_cookies),
+        Case("db.get_user[1 thread]", get_user),
+        Case("db.set_cookies[1 thread]", set_cookies),
+        Case("db.get_cookies[4 threads]", threaded_get_cookies, THREADED_THRESHOLD),
+        Case("db.set_cookies[4 threads]", threaded_set_cookies, THREADED_THRESHOLD),
+    ]
+    for users in USER_COUNTS:
+        def due_before(ctx, users=users):
+            from config import REFRESH_LOAD_LIMIT
+            ctx.grow(users)
+            # The refresh scheduler's query: the users expiring within the next day, up to its limit
+            return time_per_op(lambda: ctx.db.get_users_due_before(ctx.now + 86400, REFRESH_LOAD_LIMIT),
+                               ctx.scaled(50))
+        cases.append(Case(f"db.get_users_due_before[{users} users]", due_before))
+    return cases
+
+
+def cookie_cases():
+    def setup():
+        from benchmarks.php_session import identity_cookies
+        return [f"PHPSESSID=s{index}; identity={cookie}" for index, cookie in enumerate(identity_cookies(1000))]
+
+    def parse_uncached(ctx):
+        from laundry.php_session import decode_identity_cookie
+        from laundry.sessions import Session
+        headers = setup()
+
+        def parse_all():
+            decode_identity_cookie.cache_clear()
+            for header in headers:
+                Session(header)
+        return time_per_op(parse_all, ctx.scaled(10)) / len(headers)
+
+    def parse_cached(ctx):
+        from laundry.sessions import Session
+        headers = setup()
+
+        def parse_all():
+            for header in headers:
+                Session(header)
+        parse_all()
+        return time_per_op(parse_all, ctx.scaled(10)) / len(headers)
+
+    return [
+        Case("cookies.session[uncached]", parse_uncached),
+        Case("cookies.session[memoized]", parse_cached),
+    ]
+
+
+def transaction_cases():
+    def streaming_sum(ctx):
+        from benchmarks.transaction_parse import streaming_sum, synthetic_history
+        body = synthetic_history(HISTORY_SIZE)
+        return time_per_op(lambda: streaming_sum(body, 65536), ctx.scaled(5), repeat=5)
+
+    def get_transactions_sum(ctx, chat_ids):
+        import httpx
+        from benchmarks.transaction_parse import synthetic_history
+        from laundry import client
+        from laundry.account_balance import get_transactions_sum
+        body = synthetic_history(HISTORY_SIZE)
+
+        for chat_id in set(chat_ids):
+            ctx.db.set_cookies(chat_id, ctx.cookies)
+
+        async def run():
+            client.init_client(httpx.MockTransport(lambda request: httpx.Response(200, content=body)))
+            timings = []
+            try:
+                for chat_id in chat_ids:
+                    calibration = calibration_sample()
+                    started = time.perf_counter()
+                    await get_transactions_sum(chat_id)
+                    timings.append(time.perf_counter() - started)
+                    record_round(timings[-1], calibration)
+            finally:
+                await client.close_client()
+            return timings
+        return asyncio.run(run())
+
+    def first_sync(ctx):
+        # New chats (outside the range the database cases write to): every transaction is inserted
+        return statistics.median(get_transactions_sum(ctx, range(-1, -1 - ctx.scaled(REPEAT), -1)))
+
+    def repeated_sync(ctx):
+        # The same chat again: every transaction is already known after the untimed first sync
+        get_transactions_sum(ctx, [-1000])
+        _round_ratios.clear()
+        return statistics.median(get_transactions_sum(ctx, [-1000] * ctx.scaled(REPEAT)))
+
+    return [
+        Case(f"transactions.streaming_sum[{HISTORY_SIZE} entries]", streaming_sum),
+        Case(f"transactions.get_transactions_sum[{HISTORY_SIZE} new]", first_sync),
+        Case(f"transactions.get_transactions_sum[{HISTORY_SIZE} known]", repeated_sync),
+    ]
+
+
+def bot_cases():
+    def topup_keyboard(ctx):
+        from bot.utils import build_topup_keyboard
+        return time_per_op(build_topup_keyboard, ctx.scaled(5000))
+
+    return [Case("bot.build_topup_keyboard", topup_keyboard)]
+
+
+def all_cases():
+    return db_cases() + cookie_cases() + transaction_cases() + bot_cases()
+
+
+def load_baseline(path) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(path, entries):
+    data = {
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "recorded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "cases": entries,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="only run the cases whose name contains this")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown against the baseline, as a fraction")
+    parser.add_argument("--quick", action="store_true",
+                        help="fewer iterations, for a smoke run; not compared with the baseline")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+    if args.quick and args.save_baseline:
+        parser.error("--quick results cannot be saved as the baseline")
+
+    # Quick runs time too few iterations to compare with a full baseline
+    baseline = {} if args.quick else load_baseline(args.baseline).get("cases", {})
+    cases = [case for case in all_cases() if args.filter in case.name]
+    entries = {}
+    regressions = []
+    print(f"{'case':<48} {'us/op':>12} {'baseline':>12} {'change':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        ctx = Context(tmp, args.quick)
+        for case in cases:
+            _round_ratios.clear()
+            seconds = case.run(ctx)
+            # The calibration time that the case's typical round was measured against
+            calibration = seconds / statistics.median(_round_ratios)
+            entries[case.name] = {"seconds_per_op": seconds, "calibration_seconds": calibration}
+            line = f"{case.name:<48} {seconds * 1e6:>12.2f}"
+            recorded = baseline.get(case.name)
+            # Entries recorded without their own calibration cannot be compared
+            if recorded and recorded.get("calibration_seconds"):
+                # The baseline time as expected on this machine in its current state
+                expected = recorded["seconds_per_op"] * calibration / recorded["calibration_seconds"]
+                change = seconds / expected - 1
+                threshold = case.threshold if case.threshold is not None else args.threshold
+                line += f" {expected * 1e6:>12.2f} {change:>+8.0%}"
+                if change > threshold:
+                    regressions.append(case.name)
+                    line += "  REGRESSION"
+            print(line, flush=True)
+        ctx.db.close()
+
+    if args.save_baseline:
+        # Cases left out by --filter keep their previous baseline
+        merged = dict(baseline)
+        merged.update(entries)
+        save_baseline(args.baseline, merged)
+        print(f"\nBaseline saved to {args.baseline}")
+    if regressions and not args.save_baseline:
+        print(f"\n{len(regressions)} case(s) slower than the baseline allows: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compares the original transaction summing (json.loads of the whole list plus a float sum) with the
+streaming parser (laundry.json_stream) plus exact Decimal summing, on synthetic histories.
+
+Usage: python -m benchmarks.transaction_parse [--sizes 10000,100000] [--chunk-size 65536]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import tracemalloc
+from decimal import Decimal
+
+from laundry.json_stream import iter_json_array
+
+
+def synthetic_history(size, seed=0) -> bytes:
+    rng = random.Random(seed)
+    return json.dumps([
+        {
+            "Id": index,
+            "Date": f"2024-{index % 12 + 1:02d}-{index % 28 + 1:02d} 12:00:00",
+            "Value": rng.choice([10, 15, 20, 50]) if index % 5 == 0 else -rng.choice([3.5, 4.2, 6.1]),
+            "Description": "Pranie",
+        }
+        for index in range(size)
+    ]).encode()
+
+
+def full_parse_sum(body: bytes) -> str:
+    transactions = json.loads(body)
+    return "{:.2f}".format(round(sum(item.get("Value", 0) for item in transactions), 2))
+
+
+async def _chunks(body: bytes, chunk_size: int):
+    for start in range(0, len(body), chunk_size):
+        yield body[start:start + chunk_size]
+
+
+def streaming_sum(body: bytes, chunk_size: int) -> str:
+    async def run():
+        total = Decimal(0)
+        async for item in iter_json_array(_chunks(body, chunk_size)):
+            total += Decimal(item.get("Value", 0))
+        return "{:.2f}".format(total)
+    return asyncio.run(run())
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000")
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    args = parser.parse_args()
+
+    print(f"{'entries':>8} {'path':<10} {'time ms':>9} {'peak KiB':>10}  sum")
+    for size in map(int, args.sizes.split(",")):
+        body = synthetic_history(size)
+        for name, func, extra in (("full", full_parse_sum, ()), ("streaming", streaming_sum, (args.chunk_size,))):
+            result, elapsed, peak = measure(func, body, *extra)
+            print(f"{size:>8} {name:<10} {elapsed * 1000:>9.1f} {peak / 1024:>10.0f}  {result}")
+
+
+if __name__ == "__main__":
+    main()
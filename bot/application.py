@@ -0,0 +1,159 @@
+import asyncio
+import functools
+
+from telegram import Update
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    ConversationHandler,
+    MessageHandler,
+    filters,
+    CallbackQueryHandler,
+    PicklePersistence,
+    PersistenceInput,
+    TypeHandler,
+)
+
+from bot import handlers
+from bot.outbox import outbox, outbox_daemon
+from bot.profiling import profiling
+from bot.update_processor import PerChatUpdateProcessor
+from config import (
+    TELEGRAM_TOKEN,
+    BOT_MODE,
+    CONCURRENT_UPDATES,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET_PATH,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS,
+    METRICS_HOST,
+    METRICS_PORT,
+    BALANCE_POLLER_ENABLED,
+    PERSISTENCE_FILE,
+    SNAPSHOT_FILE,
+    SNAPSHOT_INTERVAL,
+)
+from laundry.client import close_client
+from laundry.leader import refresh_leader, outbox_leader
+from laundry.poller import balance_poller, balance_poll_daemon
+from laundry.scheduler import refresh_scheduler, refresh_cookies_daemon
+from laundry.snapshot import restore_snapshot, save_snapshot, snapshot_daemon
+from metrics.server import start_metrics_server
+
+background_tasks = []
+background_servers = []
+
+
+async def start_background_tasks(application: Application, snapshot_file=SNAPSHOT_FILE,
+                                 metrics_port=METRICS_PORT) -> None:
+    """
+    Restores the last snapshot, then starts the cookie refresher and the outgoing message queue
+    (each in the process holding its lease), the optional balance poller, the snapshot writer
+    and the metrics endpoint on the bot's event loop so they never block update handling.
+    """
+    await restore_snapshot(snapshot_file)
+    outbox.bot = application.bot
+    refresh_scheduler.on_failure = handlers.notify_refresh_failure
+    background_tasks.append(asyncio.create_task(refresh_leader.run(refresh_cookies_daemon)))
+    background_tasks.append(asyncio.create_task(outbox_leader.run(outbox_daemon)))
+    background_tasks.append(asyncio.create_task(snapshot_daemon(snapshot_file)))
+    if BALANCE_POLLER_ENABLED:
+        balance_poller.notify = handlers.notify_balance_change
+        background_tasks.append(asyncio.create_task(balance_poll_daemon()))
+    if metrics_port:
+        background_servers.append(await start_metrics_server(METRICS_HOST, metrics_port))
+
+
+async def stop_background_tasks(application: Application, snapshot_file=SNAPSHOT_FILE) -> None:
+    """Stops what start_background_tasks started, saves a final snapshot and closes the upstream client."""
+    for task in background_tasks:
+        task.cancel()
+    # Let the tasks run their cleanup, e.g. releasing the refresh lease
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    for server in background_servers:
+        server.close()
+    background_servers.clear()
+    await save_snapshot(snapshot_file)
+    await close_client()
+
+
+def build_application(persistence_file=PERSISTENCE_FILE, snapshot_file=SNAPSHOT_FILE, metrics_port=METRICS_PORT,
+                      updater=True) -> Application:
+    """
+    Builds the bot with all its handlers. With updater=False the application does not fetch updates
+    itself, they are put on its update_queue by a supervisor (see bot/sharding.py).
+    """
+    # Conversation state and user_data survive restarts; bot_data and chat_data are not used
+    persistence = PicklePersistence(
+        persistence_file,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+        update_interval=SNAPSHOT_INTERVAL,
+    )
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(functools.partial(start_background_tasks, snapshot_file=snapshot_file,
+                                     metrics_port=metrics_port))
+        .post_shutdown(functools.partial(stop_background_tasks, snapshot_file=snapshot_file))
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('start', handlers.start)],
+        states={
+            handlers.EXTERNAL_LOGIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.external_login)],
+            handlers.EXTERNAL_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.external_password)]
+        },
+        fallbacks=[CommandHandler('cancel', handlers.cancel)],
+        name="authentication",
+        persistent=True,
+    )
+
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('stan', handlers.stan))
+    application.add_handler(CommandHandler('doladuj', handlers.doladuj))
+    application.add_handler(CommandHandler('historia', handlers.historia))
+    application.add_handler(CommandHandler('metryki', handlers.metryki))
+    application.add_handler(CommandHandler('ogloszenie', handlers.ogloszenie))
+    application.add_handler(CommandHandler('profil', handlers.profil))
+    # Registered first: the top-up handler answers any other callback data
+    application.add_handler(
+        CallbackQueryHandler(handlers.historia_callback, pattern=handlers.HISTORY_CALLBACK_PATTERN)
+    )
+    application.add_handler(CallbackQueryHandler(handlers.button_callback))
+    # Counts every update once the handlers above are done with it, a no-op unless /profil is active
+    application.add_handler(TypeHandler(Update, profiling.count_update), group=1)
+    return application
+
+
+def check_run_settings() -> None:
+    """Fails with a readable message when BOT_MODE and the webhook settings do not allow starting the bot."""
+    if BOT_MODE not in ("polling", "webhook"):
+        raise RuntimeError(f"BOT_MODE must be 'polling' or 'webhook', not {BOT_MODE!r}")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise RuntimeError(
+            "BOT_MODE=webhook requires WEBHOOK_URL, the public HTTPS address Telegram sends updates to"
+        )
+
+
+def run_application(application: Application) -> None:
+    """Fetches updates for the application by polling or through the webhook, depending on BOT_MODE."""
+    check_run_settings()
+    if BOT_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_SECRET_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_SECRET_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
@@ -1,21 +1,81 @@
+import functools
+import logging
+import time
+
+import httpx
 from telegram import Update
 from telegram.ext import ConversationHandler, CallbackContext
 
-from bot.utils import is_logged_in, build_topup_keyboard, save_user_and_pass
-from laundry.account_balance import get_transactions_sum
+from bot.outbox import outbox
+from bot.profiling import profiling
+from bot.utils import db, is_logged_in, is_admin, build_topup_keyboard, build_history_keyboard
+from config import HISTORY_PAGE_SIZE, PROFILE_DEFAULT_UPDATES, PROFILE_MAX_SECONDS
+from laundry.account_balance import format_cents, get_balance, get_last_known_balance, refresh_balance
+from laundry.admission import chat_limiter
+from laundry.circuit import CircuitOpen
+from laundry.client import UpstreamError
 from laundry.cookies import generate_session_cookies
+from laundry.poller import balance_poller
+from laundry.scheduler import refresh_scheduler
 from laundry.topup import topup_account
+from metrics.registry import REGISTRY, instrument
+
+logger = logging.getLogger(__name__)
 
 # Conversation stages
 EXTERNAL_LOGIN, EXTERNAL_PASSWORD = range(2)
 
+# Telegram messages are limited to 4096 characters
+MAX_MESSAGE_LENGTH = 4096
+
+SLOW_DOWN_MESSAGE = "Zbyt wiele zapytań. Spróbuj ponownie za chwilę."
+UNAVAILABLE_MESSAGE = "Serwis pralni jest chwilowo niedostępny. Spróbuj ponownie za chwilę."
+
+# Errors meaning that the laundry service is down or misbehaving, as opposed to a problem with the user's account
+UPSTREAM_FAILURES = (CircuitOpen, UpstreamError, httpx.HTTPError)
+
+# Callback data of the /historia navigation buttons, kept apart from the top-up options
+HISTORY_CALLBACK_PATTERN = r"^historia:(newer|older):\d{4}-\d{2}$"
+MONTH_NAMES = (
+    "styczeń", "luty", "marzec", "kwiecień", "maj", "czerwiec",
+    "lipiec", "sierpień", "wrzesień", "październik", "listopad", "grudzień",
+)
+
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "Latency of bot handlers", ["handler"])
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "Exceptions raised by bot handlers", ["handler"])
+
+
+def instrumented(func):
+    """Records the latency and errors of a handler."""
+    return instrument(HANDLER_SECONDS, HANDLER_ERRORS, handler=func.__name__)(func)
+
 
+def rate_limited(func):
+    """
+    Answers a command that may reach the laundry service with a request to slow down instead
+    when the chat is over its limit. Returning None keeps a conversation in its current state.
+    """
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: CallbackContext):
+        if chat_limiter.allow(update.effective_chat.id):
+            return await func(update, context)
+        if update.callback_query is not None:
+            await update.callback_query.answer(SLOW_DOWN_MESSAGE)
+        else:
+            await update.message.reply_text(SLOW_DOWN_MESSAGE)
+        return None
+
+    return wrapper
+
+
+@instrumented
 async def start(update: Update, context: CallbackContext) -> int:
     """Starts the authentication conversation by requesting the login."""
     await update.message.reply_text("Podaj login do serwisu pralni:")
     return EXTERNAL_LOGIN
 
 
+@instrumented
 async def external_login(update: Update, context: CallbackContext) -> int:
     """Stores the login and asks for the password."""
     login = update.message.text.strip()
@@ -24,37 +84,63 @@ async def external_login(update: Update, context: CallbackContext) -> int:
     return EXTERNAL_PASSWORD
 
 
+@instrumented
+@rate_limited
 async def external_password(update: Update, context: CallbackContext) -> int:
     """
     Attempts authentication using the provided login and password.
-    On success, saves credentials and notifies the user.
+    On success, the credentials are saved together with the session cookies and the user is notified.
     On failure, restarts the login process.
     """
     login = context.user_data.get("pralni_login")
     password = update.message.text.strip()
     chat_id = update.message.chat_id
 
-    auth_result = generate_session_cookies(login, password, chat_id)
+    try:
+        auth_result = await generate_session_cookies(login, password, chat_id)
+    except UPSTREAM_FAILURES:
+        # Staying in the current state lets the user send the password again later
+        await update.message.reply_text(UNAVAILABLE_MESSAGE)
+        return None
     if auth_result is None:
         await update.message.reply_text("Niepoprawne dane. Spróbuj jeszcze raz. Podaj login:")
         return EXTERNAL_LOGIN
-    save_user_and_pass(chat_id, login, password)
+    await refresh_scheduler.track(chat_id)
+    balance_poller.touch(chat_id)
+    # The user is logged in at this point, whatever happens to the first balance fetch
+    try:
+        balance = await refresh_balance(chat_id)
+    except Exception as e:
+        logger.warning("Could not fetch the balance after login for chat_id %s: %s", chat_id, e)
+        balance = None
+    if balance is not None:
+        balance_line = f"Aktualny stan konta: {balance}\n"
+    else:
+        balance_line = "Nie udało się teraz pobrać stanu konta, sprawdź go za chwilę przez /stan.\n"
     await update.message.reply_text(
         "Zalogowano w serwisie pralni!\n"
-        f"Aktualny stan konta: {get_transactions_sum(chat_id)}\n"
-        "Możesz teraz korzystać z komend /stan oraz /doladuj."
+        f"{balance_line}"
+        "Możesz teraz korzystać z komend /stan, /doladuj oraz /historia."
     )
     return ConversationHandler.END
 
 
+@instrumented
+@rate_limited
 async def stan(update: Update, context: CallbackContext) -> None:
     """
     Displays the current account balance if the user is authenticated.
     Notifies the user if not logged in or if there's an error fetching the balance.
+    While the laundry service is unavailable, the last known balance is shown with its date.
     """
     chat_id = update.message.chat_id
-    if is_logged_in(chat_id):
-        balance = get_transactions_sum(chat_id)
+    if await is_logged_in(chat_id):
+        balance_poller.touch(chat_id)
+        try:
+            balance = await get_balance(chat_id)
+        except UPSTREAM_FAILURES:
+            await reply_last_known_balance(update, chat_id)
+            return
         if balance is not None:
             await update.message.reply_text(f"Stan Twojego konta: {balance}")
         else:
@@ -63,20 +149,38 @@ async def stan(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text("Nie jesteś zalogowany. Użyj /start aby się zalogować.")
 
 
+async def reply_last_known_balance(update: Update, chat_id: int) -> None:
+    """Answers /stan from the last known balance when the laundry service cannot be reached."""
+    entry = await get_last_known_balance(chat_id)
+    if entry is None:
+        await update.message.reply_text(UNAVAILABLE_MESSAGE)
+        return
+    fetched_at = time.strftime("%d.%m.%Y %H:%M", time.localtime(entry.fetched_at))
+    await update.message.reply_text(
+        "Serwis pralni jest chwilowo niedostępny.\n"
+        f"Ostatni znany stan Twojego konta: {entry.value} (z {fetched_at})"
+    )
+
+
+@instrumented
+@rate_limited
 async def doladuj(update: Update, context: CallbackContext) -> None:
     """
     Sends the user an inline keyboard to choose a top-up amount.
     If the user is not logged in, they are informed accordingly.
     """
     chat_id = update.message.chat_id
-    if not is_logged_in(chat_id):
+    if not await is_logged_in(chat_id):
         await update.message.reply_text("Nie jesteś zalogowany. Użyj /start aby się zalogować.")
         return
 
+    balance_poller.touch(chat_id)
     reply_markup = build_topup_keyboard()
     await update.message.reply_text("Wybierz kwotę doładowania:", reply_markup=reply_markup)
 
 
+@instrumented
+@rate_limited
 async def button_callback(update: Update, context: CallbackContext) -> None:
     """
     Handles callback queries from the top-up selection.
@@ -92,14 +196,167 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
         await query.edit_message_text("Wybrano niepoprawną opcję.")
         return
 
-    top_up_link = topup_account(chat_id, selected_option)
+    try:
+        top_up_link = await topup_account(chat_id, selected_option)
+    except UPSTREAM_FAILURES:
+        await query.edit_message_text(UNAVAILABLE_MESSAGE)
+        return
     if top_up_link:
+        # Poll soon so the user hears about the top-up once it clears
+        balance_poller.touch(chat_id)
         await query.edit_message_text(f"Link do doładowania: {top_up_link}")
     else:
         await query.edit_message_text("Nie udało się pobrać linka do doładowania.")
 
 
+def format_history_page(months) -> str:
+    """Formats monthly_spending rows, newest first, as the text of a /historia page."""
+    if not months:
+        return "Brak zapisanych transakcji."
+    lines = ["Historia konta:"]
+    for row in months:
+        year, month = row['month'].split("-")
+        lines.append(
+            f"\n{MONTH_NAMES[int(month) - 1]} {year}\n"
+            f"Pranie: {format_cents(row['wash_cents'])} zł ({row['wash_count']})\n"
+            f"Doładowania: {format_cents(row['topup_cents'])} zł ({row['topup_count']})"
+        )
+    return "\n".join(lines)
+
+
+async def history_page(chat_id: int, direction: str = None, cursor: str = None):
+    """
+    Returns the text and navigation keyboard of a /historia page: the newest months, or the months
+    older or newer (direction) than the cursor month. One extra month is read to tell whether
+    there is a further page, the opposite direction always has one.
+    """
+    if direction == "newer":
+        months = await db.aio.get_monthly_spending(chat_id, after=cursor, limit=HISTORY_PAGE_SIZE + 1)
+        more = len(months) > HISTORY_PAGE_SIZE
+        months = months[-HISTORY_PAGE_SIZE:]
+        has_newer, has_older = more, True
+    else:
+        months = await db.aio.get_monthly_spending(chat_id, before=cursor, limit=HISTORY_PAGE_SIZE + 1)
+        more = len(months) > HISTORY_PAGE_SIZE
+        months = months[:HISTORY_PAGE_SIZE]
+        has_newer, has_older = cursor is not None, more
+    if not months:
+        return format_history_page(months), None
+    keyboard = build_history_keyboard(
+        newer_than=months[0]['month'] if has_newer else None,
+        older_than=months[-1]['month'] if has_older else None,
+    )
+    return format_history_page(months), keyboard
+
+
+@instrumented
+@rate_limited
+async def historia(update: Update, context: CallbackContext) -> None:
+    """
+    Shows the user's top-ups and washes per month, newest first, with buttons to page through older months.
+    The months come from the stored aggregates; the transactions are synced first like for /stan.
+    """
+    chat_id = update.message.chat_id
+    if not await is_logged_in(chat_id):
+        await update.message.reply_text("Nie jesteś zalogowany. Użyj /start aby się zalogować.")
+        return
+    balance_poller.touch(chat_id)
+    try:
+        await get_balance(chat_id)
+    except UPSTREAM_FAILURES:
+        # The months already stored are still worth showing
+        pass
+    text, reply_markup = await history_page(chat_id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+
+@instrumented
+async def historia_callback(update: Update, context: CallbackContext) -> None:
+    """Shows another page of /historia, read from the stored monthly aggregates only."""
+    query = update.callback_query
+    await query.answer()
+    _, direction, cursor = query.data.split(":")
+    text, reply_markup = await history_page(query.message.chat_id, direction, cursor)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+
+@instrumented
 async def cancel(update: Update, context: CallbackContext) -> int:
     """Cancels the authentication process."""
     await update.message.reply_text("Anulowano proces autentykacji.")
     return ConversationHandler.END
+
+
+async def notify_balance_change(chat_id: int, old: str, new: str) -> None:
+    """Tells the user that the background poller noticed a change of their balance."""
+    await outbox.send(chat_id, f"Stan Twojego konta zmienił się: {old} → {new}")
+
+
+async def notify_refresh_failure(chat_id: int) -> None:
+    """Tells the user that their stored credentials no longer work."""
+    await outbox.send(
+        chat_id,
+        "Nie udało się odświeżyć sesji w serwisie pralni. Jeśli hasło się zmieniło, zaloguj się ponownie przez /start."
+    )
+
+
+@instrumented
+async def metryki(update: Update, context: CallbackContext) -> None:
+    """Sends a summary of the collected metrics to an admin."""
+    if not is_admin(update.message.chat_id):
+        return
+    summary = REGISTRY.summary() or "Brak danych."
+    await update.message.reply_text(summary[:MAX_MESSAGE_LENGTH])
+
+
+@instrumented
+async def ogloszenie(update: Update, context: CallbackContext) -> None:
+    """Lets an admin queue an announcement to every logged in user: /ogloszenie <treść>."""
+    if not is_admin(update.message.chat_id):
+        return
+    text = update.message.text.partition(" ")[2].strip()
+    if not text:
+        await update.message.reply_text("Użycie: /ogloszenie <treść>")
+        return
+    chat_ids = await db.aio.get_logged_in_chat_ids()
+    count = await outbox.send_many((chat_id, text) for chat_id in chat_ids)
+    await update.message.reply_text(f"Zakolejkowano ogłoszenie do {count} użytkowników.")
+
+
+@instrumented
+async def profil(update: Update, context: CallbackContext) -> None:
+    """
+    Lets an admin profile the bot: /profil [N] profiles the next N updates, /profil Ns the next N seconds
+    (never longer than PROFILE_MAX_SECONDS) and /profil stop ends profiling early.
+    The report is written to PROFILE_DIR and its summary is sent back to the admin.
+    """
+    chat_id = update.message.chat_id
+    if not is_admin(chat_id):
+        return
+    args = context.args or []
+    if args and args[0] == "stop":
+        if profiling.active:
+            await profiling.stop()
+        else:
+            await update.message.reply_text("Profilowanie nie jest włączone.")
+        return
+    if profiling.active:
+        await update.message.reply_text("Profilowanie już trwa. Użyj /profil stop aby je zakończyć.")
+        return
+
+    max_updates, seconds = PROFILE_DEFAULT_UPDATES, PROFILE_MAX_SECONDS
+    try:
+        if args and args[0].endswith("s"):
+            max_updates, seconds = None, min(float(args[0][:-1]), PROFILE_MAX_SECONDS)
+        elif args:
+            max_updates = int(args[0])
+    except ValueError:
+        await update.message.reply_text("Użycie: /profil [liczba aktualizacji | liczba sekund, np. 30s | stop]")
+        return
+
+    async def done(path, summary):
+        await context.bot.send_message(chat_id, f"Profilowanie zakończone: {summary}\nRaport: {path}")
+
+    profiling.start(done, max_updates, seconds)
+    limit = f"{max_updates} aktualizacji" if max_updates is not None else f"{seconds:g} s"
+    await update.message.reply_text(f"Profilowanie włączone na {limit}.")
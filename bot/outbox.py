@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from config import (
+    OUTBOX_RATE_PER_SECOND,
+    OUTBOX_PER_CHAT_INTERVAL,
+    OUTBOX_MAX_CONCURRENT,
+    OUTBOX_BATCH_SIZE,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_DELAY,
+    OUTBOX_POLL_INTERVAL,
+)
+from database.db import UserDatabase
+from laundry.ratelimit import TokenBucket
+from metrics.registry import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Window over which the sustained send rate is reported
+THROUGHPUT_WINDOW = 60
+
+OUTBOX_MESSAGES = REGISTRY.counter(
+    "outbox_messages_total", "Outgoing messages by delivery result", ["result"]
+)
+OUTBOX_DELIVERY_SECONDS = REGISTRY.histogram(
+    "outbox_delivery_seconds", "Time from queueing an outgoing message to its delivery",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+)
+
+
+class Outbox:
+    """
+    Persistent queue of outgoing Telegram messages, used for notifications and broadcasts
+    that are not replies to an update. Messages are stored in the database first, so they
+    survive restarts, and are delivered by run() within a global rate, at most one message
+    per chat every per_chat_interval seconds and one at a time per chat. RetryAfter pauses
+    all sending for the time Telegram asks for; other errors are retried with backoff.
+    """
+
+    def __init__(self, rate_per_second=OUTBOX_RATE_PER_SECOND, per_chat_interval=OUTBOX_PER_CHAT_INTERVAL,
+                 max_concurrent=OUTBOX_MAX_CONCURRENT, batch_size=OUTBOX_BATCH_SIZE,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, retry_delay=OUTBOX_RETRY_DELAY,
+                 poll_interval=OUTBOX_POLL_INTERVAL, bot=None):
+        self.per_chat_interval = per_chat_interval
+        self.max_concurrent = max_concurrent
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.bot = bot
+        self._bucket = TokenBucket(rate_per_second, max(1.0, rate_per_second))
+        # chat_id -> monotonic time from which the chat may get its next message
+        self._chat_ready = {}
+        self._busy_chats = set()
+        self._in_flight = set()
+        # Ids of delivered or dropped messages, deleted from the database in one go
+        self._finished = []
+        self._paused_until = 0.0
+        self._sent_times = deque()
+        self._tasks = set()
+        self._wakeup = None
+        self._semaphore = None
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def send(self, chat_id: int, text: str):
+        """Queues a message for chat_id."""
+        await self.send_many([(chat_id, text)])
+
+    async def send_many(self, messages) -> int:
+        """Queues (chat_id, text) messages in one write and returns how many were queued."""
+        count = await UserDatabase().aio.enqueue_messages(list(messages))
+        self._wake()
+        return count
+
+    def throughput(self) -> float:
+        """Messages delivered per second over the last THROUGHPUT_WINDOW seconds."""
+        cutoff = time.monotonic() - THROUGHPUT_WINDOW
+        while self._sent_times and self._sent_times[0] < cutoff:
+            self._sent_times.popleft()
+        return len(self._sent_times) / THROUGHPUT_WINDOW
+
+    def _ready(self, chat_id: int, now: float) -> bool:
+        return chat_id not in self._busy_chats and self._chat_ready.get(chat_id, 0.0) <= now
+
+    async def _postpone(self, message_id, not_before, attempts):
+        try:
+            await UserDatabase().aio.postpone_message(message_id, not_before, attempts)
+        except Exception as e:
+            # The message stays due, so it is sent again at the next poll
+            logger.error("Error postponing message %s: %s", message_id, e)
+
+    async def _deliver(self, message):
+        message_id, chat_id = message['id'], message['chat_id']
+        finished = False
+        try:
+            await self.bot.send_message(chat_id, message['text'])
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            self._paused_until = max(self._paused_until, time.time() + retry_after)
+            logger.warning("Telegram asked to retry after %s s, pausing the outbox", retry_after)
+            OUTBOX_MESSAGES.inc(result="retry_after")
+            await self._postpone(message_id, self._paused_until, message['attempts'])
+        except (Forbidden, BadRequest) as e:
+            # The user blocked the bot or the chat is gone, retrying will not help
+            logger.info("Dropping message %s for chat_id %s: %s", message_id, chat_id, e)
+            OUTBOX_MESSAGES.inc(result="rejected")
+            finished = True
+        except TelegramError as e:
+            attempts = message['attempts'] + 1
+            if attempts >= self.max_attempts:
+                logger.error("Giving up on message %s for chat_id %s after %s attempts: %s",
+                             message_id, chat_id, attempts, e)
+                OUTBOX_MESSAGES.inc(result="failed")
+                finished = True
+            else:
+                logger.warning("Sending message %s for chat_id %s failed: %s", message_id, chat_id, e)
+                OUTBOX_MESSAGES.inc(result="error")
+                await self._postpone(message_id, time.time() + self.retry_delay * 2 ** (attempts - 1), attempts)
+        else:
+            OUTBOX_MESSAGES.inc(result="sent")
+            OUTBOX_DELIVERY_SECONDS.observe(time.time() - message['created_at'])
+            self._sent_times.append(time.monotonic())
+            finished = True
+        finally:
+            if finished:
+                # Deleted from the database by the next flush, until then it must not be sent again
+                self._finished.append(message_id)
+            else:
+                self._in_flight.discard(message_id)
+            self._busy_chats.discard(chat_id)
+            self._semaphore.release()
+            self._wake()
+
+    async def _flush_finished(self):
+        if not self._finished:
+            return
+        # Messages finishing meanwhile are appended, keep them for the next flush
+        finished = list(self._finished)
+        await UserDatabase().aio.delete_messages(finished)
+        del self._finished[:len(finished)]
+        self._in_flight.difference_update(finished)
+
+    def _forget_idle_chats(self, now):
+        if len(self._chat_ready) > self.batch_size:
+            self._chat_ready = {chat_id: ready for chat_id, ready in self._chat_ready.items() if ready > now}
+
+    async def _dispatch(self, batch) -> int:
+        dispatched = 0
+        for message in batch:
+            now = time.monotonic()
+            if message['id'] in self._in_flight or not self._ready(message['chat_id'], now):
+                continue
+            if self._paused_until > time.time():
+                break
+            await self._semaphore.acquire()
+            await self._bucket.acquire()
+            self._in_flight.add(message['id'])
+            self._busy_chats.add(message['chat_id'])
+            self._chat_ready[message['chat_id']] = time.monotonic() + self.per_chat_interval
+            task = asyncio.create_task(self._deliver(message))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            dispatched += 1
+        return dispatched
+
+    def _next_wakeup(self, batch) -> float:
+        """Seconds until the next message of the batch may be sent, capped at poll_interval."""
+        now = time.monotonic()
+        waits = [max(0.0, self._chat_ready.get(message['chat_id'], 0.0) - now) for message in batch
+                 if message['id'] not in self._in_flight and message['chat_id'] not in self._busy_chats]
+        return min(waits + [self.poll_interval])
+
+    async def run(self):
+        """Delivers queued messages forever on the current event loop."""
+        if self.bot is None:
+            raise RuntimeError("Outbox.bot must be set before run()")
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        db = UserDatabase()
+        while True:
+            self._wakeup.clear()
+            paused = self._paused_until - time.time()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            try:
+                await self._flush_finished()
+                batch = await db.aio.get_due_messages(time.time(), self.batch_size)
+                if batch and await self._dispatch(batch):
+                    continue
+                self._forget_idle_chats(time.monotonic())
+                timeout = self._next_wakeup(batch)
+                if not batch:
+                    next_time = await db.aio.get_next_message_time()
+                    if next_time is not None:
+                        timeout = max(0.0, min(timeout, next_time - time.time()))
+            except Exception as e:
+                # Keep delivering once the database is back, finished messages are deleted then
+                logger.error("Error reading the outbox: %s", e)
+                timeout = self.poll_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox = Outbox()
+
+REGISTRY.gauge(
+    "outbox", "Outgoing message queue: sustained send rate per second and messages being sent", ["stat"],
+    callback=lambda: {
+        ("sent_per_second",): round(outbox.throughput(), 2),
+        ("in_flight",): len(outbox._in_flight),
+    }
+)
+
+
+async def outbox_daemon():
+    """
+    Runs the outgoing message queue on the bot's event loop.
+    """
+    await outbox.run()
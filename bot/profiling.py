@@ -0,0 +1,107 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from config import PROFILE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Number of functions listed in each section of a report
+TOP_FUNCTIONS = 30
+
+
+class ProfilingSession:
+    """
+    Profiles the event loop thread, where all handlers run, until a number of updates
+    has been handled or a time window has passed, then writes a report.
+    Off by default: nothing is traced until start() is called.
+    """
+
+    def __init__(self):
+        self._profile = None
+        self._timer = None
+        self._stop_task = None
+        self._done = None
+        self.updates = 0
+        self.max_updates = None
+        self.started_wall = 0.0
+        self.started_cpu = 0.0
+        self.started_thread_cpu = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self._profile is not None
+
+    def start(self, done, max_updates=None, seconds=None):
+        """
+        Starts profiling; done(report_path, summary) is awaited when it ends.
+        Must be called on the bot's event loop.
+        """
+        self.updates = 0
+        self.max_updates = max_updates
+        self._done = done
+        self.started_wall = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self.started_thread_cpu = time.thread_time()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        if seconds is not None:
+            self._timer = asyncio.get_running_loop().call_later(seconds, self._expire)
+        logger.info("Profiling started for %s updates or %s s", max_updates, seconds)
+
+    def _expire(self):
+        self._timer = None
+        self._stop_task = asyncio.create_task(self.stop())
+
+    async def count_update(self, update: Update, context: CallbackContext) -> None:
+        """Counts handled updates; registered for every update after the other handlers."""
+        if not self.active:
+            return
+        self.updates += 1
+        if self.max_updates is not None and self.updates >= self.max_updates:
+            await self.stop()
+
+    async def stop(self):
+        """Stops profiling, writes the report and hands it to the done callback."""
+        if not self.active:
+            return
+        profile, self._profile = self._profile, None
+        profile.disable()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        summary = (
+            f"{self.updates} updates, {time.perf_counter() - self.started_wall:.2f} s wall, "
+            f"{time.process_time() - self.started_cpu:.2f} s CPU in the process, "
+            f"{time.thread_time() - self.started_thread_cpu:.2f} s CPU on the event loop thread"
+        )
+        path = await asyncio.to_thread(self._write_report, profile, summary)
+        logger.info("Profiling finished (%s), report written to %s", summary, path)
+        await self._done(path, summary)
+
+    @staticmethod
+    def _write_report(profile, summary) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S"))
+        # The raw profile can be explored further with pstats or snakeviz
+        profile.dump_stats(f"{base}.prof")
+        report = io.StringIO()
+        report.write(f"{summary}\n\n")
+        stats = pstats.Stats(profile, stream=report)
+        report.write(f"Top {TOP_FUNCTIONS} functions by cumulative time\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+        report.write(f"Top {TOP_FUNCTIONS} functions by own time\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(TOP_FUNCTIONS)
+        with open(f"{base}.txt", "w") as f:
+            f.write(report.getvalue())
+        return f"{base}.txt"
+
+
+profiling = ProfilingSession()
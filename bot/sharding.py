@@ -0,0 +1,102 @@
+"""
+Multi-process mode: a supervisor fetches Telegram updates and hands each one to one of WORKERS
+worker processes, always the same one for a given chat, so conversation state, per-chat ordering
+and the per-process caches stay consistent. Workers share the SQLite database; the cookie refresher
+runs only in the worker holding the refresh lease (see laundry/leader.py).
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from config import TELEGRAM_TOKEN, METRICS_PORT, PERSISTENCE_FILE, SNAPSHOT_FILE
+
+logger = logging.getLogger(__name__)
+
+# Seconds a worker gets to finish its updates and save its state at shutdown
+WORKER_SHUTDOWN_TIMEOUT = 30
+
+
+def shard_for(update: Update, workers: int) -> int:
+    """Returns the index of the worker responsible for the chat (or user) of the update."""
+    if update.effective_chat is not None:
+        return update.effective_chat.id % workers
+    if update.effective_user is not None:
+        return update.effective_user.id % workers
+    return 0
+
+
+async def serve_worker(index: int, updates) -> None:
+    """Runs the bot on updates received from the supervisor until it sends None."""
+    # Imported here so that the supervisor does not build the handler stack it never uses
+    from bot.application import build_application
+
+    application = build_application(
+        persistence_file=f"{PERSISTENCE_FILE}.{index}",
+        snapshot_file=f"{SNAPSHOT_FILE}.{index}",
+        metrics_port=METRICS_PORT + 1 + index if METRICS_PORT else 0,
+        updater=False,
+    )
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        logger.info("Worker %s started", index)
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            await application.stop()
+            await application.post_shutdown(application)
+    logger.info("Worker %s stopped", index)
+
+
+def run_worker(index: int, updates) -> None:
+    """Entry point of a worker process."""
+    # Ctrl+C reaches the whole process group; workers stop when the supervisor tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        force=True
+    )
+    asyncio.run(serve_worker(index, updates))
+
+
+def run_sharded(workers: int) -> None:
+    """Starts the worker processes and feeds them updates fetched by polling or through the webhook."""
+    from bot.application import check_run_settings, run_application
+
+    # Before any worker is started
+    check_run_settings()
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [
+        context.Process(target=run_worker, args=(index, queue), name=f"worker-{index}")
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+
+    async def route(update: Update, context) -> None:
+        queues[shard_for(update, workers)].put(update.to_dict())
+
+    async def stop_workers(application: Application) -> None:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, WORKER_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logger.warning("%s did not stop in time, terminating it", process.name)
+                process.terminate()
+
+    supervisor = Application.builder().token(TELEGRAM_TOKEN).post_shutdown(stop_workers).build()
+    supervisor.add_handler(TypeHandler(Update, route))
+    logger.info("Routing updates to %s workers", workers)
+    run_application(supervisor)
@@ -0,0 +1,50 @@
+import asyncio
+import sys
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently while updates of the same chat
+    are handled one by one, in the order they arrived. This keeps the ConversationHandler
+    login flow consistent with concurrent updates enabled.
+
+    At most max_concurrent_updates updates run at once. The limit is taken only once an
+    update's chat turn has come, so updates queued behind their own chat do not hold slots
+    that other chats could use.
+    """
+
+    __slots__ = ("_chat_locks", "_slots", "limit")
+
+    def __init__(self, max_concurrent_updates: int):
+        # process_update() takes the base class semaphore before the chat lock, so it must never block
+        super().__init__(sys.maxsize)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self._chat_locks = {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self) -> None:
+        """Nothing to set up."""
+
+    async def shutdown(self) -> None:
+        """Nothing to clean up."""
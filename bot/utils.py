@@ -1,6 +1,8 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+from config import ADMIN_CHAT_IDS
 from database.db import UserDatabase
+from laundry.sessions import get_session
 
 db = UserDatabase()
 
@@ -17,12 +19,25 @@ def build_topup_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
-def is_logged_in(chat_id: int) -> bool:
-    """Checks if the user is logged in by verifying stored cookies."""
-    return db.get_cookies(chat_id) is not None
+def build_history_keyboard(newer_than=None, older_than=None):
+    """
+    Builds the navigation buttons of a /historia page: to the months newer than newer_than
+    and older than older_than ("YYYY-MM"), or None when there is nowhere to go.
+    """
+    buttons = []
+    if newer_than is not None:
+        buttons.append(InlineKeyboardButton("« Nowsze", callback_data=f"historia:newer:{newer_than}"))
+    if older_than is not None:
+        buttons.append(InlineKeyboardButton("Starsze »", callback_data=f"historia:older:{older_than}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
 
 
-def save_user_and_pass(chat_id: int, login: str, password: str) -> None:
-    """Save user login and password to the database."""
-    db.set_username(chat_id, login)
-    db.set_password(chat_id, password)
+def is_admin(chat_id: int) -> bool:
+    """Checks if the chat belongs to one of the bot admins."""
+    return chat_id in ADMIN_CHAT_IDS
+
+
+async def is_logged_in(chat_id: int) -> bool:
+    """Checks if the user is logged in by verifying stored cookies, usually without a database query."""
+    return await get_session(chat_id) is not None
+
@@ -7,7 +7,121 @@ load_dotenv()
 # Telegram bot token
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
-# URLs for the laundry service (serwis pralni)
-PRALNIE_LOGIN_URL = "https://pralnie.org/index.php/account/login"
-PRALNIE_TOPUP_URL = "https://pralnie.org/index.php/topUp/createRequest"
-PRALNIE_BASE_TRANSACTIONS_URL = "https://pralnie.org/index.php/accountTransaction/getTransactionList"
+# URLs for the laundry service (serwis pralni), the base can point at tools/fake_pralnie.py for load tests
+PRALNIE_BASE_URL = os.getenv("PRALNIE_BASE_URL", "https://pralnie.org/index.php").rstrip("/")
+PRALNIE_LOGIN_URL = f"{PRALNIE_BASE_URL}/account/login"
+PRALNIE_TOPUP_URL = f"{PRALNIE_BASE_URL}/topUp/createRequest"
+PRALNIE_BASE_TRANSACTIONS_URL = f"{PRALNIE_BASE_URL}/accountTransaction/getTransactionList"
+
+# Upstream HTTP client settings (seconds unless stated otherwise)
+PRALNIE_CONNECT_TIMEOUT = float(os.getenv("PRALNIE_CONNECT_TIMEOUT", "5"))
+PRALNIE_LOGIN_READ_TIMEOUT = float(os.getenv("PRALNIE_LOGIN_READ_TIMEOUT", "15"))
+PRALNIE_TOPUP_READ_TIMEOUT = float(os.getenv("PRALNIE_TOPUP_READ_TIMEOUT", "15"))
+PRALNIE_TRANSACTIONS_READ_TIMEOUT = float(os.getenv("PRALNIE_TRANSACTIONS_READ_TIMEOUT", "30"))
+PRALNIE_MAX_CONNECTIONS = int(os.getenv("PRALNIE_MAX_CONNECTIONS", "20"))
+PRALNIE_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("PRALNIE_MAX_KEEPALIVE_CONNECTIONS", "10"))
+PRALNIE_KEEPALIVE_EXPIRY = float(os.getenv("PRALNIE_KEEPALIVE_EXPIRY", "60"))
+PRALNIE_GET_RETRIES = int(os.getenv("PRALNIE_GET_RETRIES", "2"))
+PRALNIE_RETRY_BACKOFF = float(os.getenv("PRALNIE_RETRY_BACKOFF", "0.5"))
+
+# Circuit breaker settings, one breaker per upstream operation (login, topup, transactions)
+# Number of recent calls the failure ratio is computed over, and how many are needed before it counts
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+# Share of failed or slow calls in the window that opens the circuit
+CIRCUIT_FAILURE_RATIO = float(os.getenv("CIRCUIT_FAILURE_RATIO", "0.5"))
+# Calls whose response takes longer than this count as failures
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "10"))
+# Seconds an open circuit rejects calls before letting trial calls through
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# Trial calls allowed at once while half-open
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", "1"))
+
+# Balance cache settings
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "60"))
+BALANCE_CACHE_MAX_STALE = float(os.getenv("BALANCE_CACHE_MAX_STALE", "3600"))
+BALANCE_CACHE_MAX_SIZE = int(os.getenv("BALANCE_CACHE_MAX_SIZE", "10000"))
+
+# Months shown per page of /historia
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "6"))
+
+# Database settings
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+
+# Cookie refresh scheduler settings
+REFRESH_DAYS_BEFORE = float(os.getenv("REFRESH_DAYS_BEFORE", "5"))
+REFRESH_RATE_PER_HOUR = float(os.getenv("REFRESH_RATE_PER_HOUR", "60"))
+REFRESH_BURST = int(os.getenv("REFRESH_BURST", "3"))
+REFRESH_MAX_CONCURRENT = int(os.getenv("REFRESH_MAX_CONCURRENT", "2"))
+REFRESH_RETRY_DELAY = float(os.getenv("REFRESH_RETRY_DELAY", "3600"))
+REFRESH_LOAD_HORIZON = float(os.getenv("REFRESH_LOAD_HORIZON", "86400"))
+REFRESH_LOAD_LIMIT = int(os.getenv("REFRESH_LOAD_LIMIT", "1000"))
+
+# Telegram update delivery: "polling" or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Public base URL under which Telegram reaches the listener (e.g. behind a reverse proxy)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET_PATH = os.getenv("WEBHOOK_SECRET_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Maximum number of updates handled at once; updates of one chat are always handled in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# Metrics endpoint (set METRICS_PORT to 0 to disable) and admins allowed to use admin commands
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv("ADMIN_CHAT_IDS", "").split(",") if chat_id.strip()}
+
+# Background balance poller (optional): polls recently active users often and idle ones rarely
+BALANCE_POLLER_ENABLED = os.getenv("BALANCE_POLLER_ENABLED", "false").lower() in ("1", "true", "yes")
+BALANCE_POLL_MIN_INTERVAL = float(os.getenv("BALANCE_POLL_MIN_INTERVAL", "120"))
+BALANCE_POLL_MAX_INTERVAL = float(os.getenv("BALANCE_POLL_MAX_INTERVAL", "21600"))
+# Poll interval as a fraction of the time since the user's last command
+BALANCE_POLL_IDLE_FACTOR = float(os.getenv("BALANCE_POLL_IDLE_FACTOR", "0.1"))
+BALANCE_POLL_FORGET_AFTER = float(os.getenv("BALANCE_POLL_FORGET_AFTER", str(7 * 86400)))
+BALANCE_POLL_RATE_PER_MINUTE = float(os.getenv("BALANCE_POLL_RATE_PER_MINUTE", "30"))
+BALANCE_POLL_MAX_CONCURRENT = int(os.getenv("BALANCE_POLL_MAX_CONCURRENT", "4"))
+
+# Warm restarts: conversation state and user_data are pickled by python-telegram-bot, caches and
+# schedules are snapshotted to JSON; both are written every SNAPSHOT_INTERVAL seconds and at shutdown
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "bot_state.pickle")
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "cache_snapshot.json")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "60"))
+
+# Multi-process mode: updates are split across WORKERS processes by chat_id, and the cookie refresher
+# runs only in the process holding the database lease (renewed every LEADER_LEASE_TTL / 3 seconds)
+WORKERS = int(os.getenv("WORKERS", "1"))
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+
+# On-demand profiling started by admins with /profil: reports are written to PROFILE_DIR
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_DEFAULT_UPDATES = int(os.getenv("PROFILE_DEFAULT_UPDATES", "500"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "600"))
+
+# Outbound message queue: Telegram allows about 30 messages per second overall and one per second per chat
+OUTBOX_RATE_PER_SECOND = float(os.getenv("OUTBOX_RATE_PER_SECOND", "25"))
+OUTBOX_PER_CHAT_INTERVAL = float(os.getenv("OUTBOX_PER_CHAT_INTERVAL", "1"))
+OUTBOX_MAX_CONCURRENT = int(os.getenv("OUTBOX_MAX_CONCURRENT", "8"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "30"))
+# How often the queue is checked for messages added by other worker processes
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+
+# Admission control for pralnie.org requests, shared by the whole deployment (split evenly across WORKERS):
+# at most UPSTREAM_MAX_CONCURRENT requests in flight and UPSTREAM_RATE_PER_SECOND started per second,
+# with interactive requests served ahead of background ones (cookie refreshes, polling)
+UPSTREAM_MAX_CONCURRENT = int(os.getenv("UPSTREAM_MAX_CONCURRENT", "10"))
+UPSTREAM_RATE_PER_SECOND = float(os.getenv("UPSTREAM_RATE_PER_SECOND", "10"))
+UPSTREAM_BURST = float(os.getenv("UPSTREAM_BURST", "20"))
+# Per-chat limit on commands that may reach pralnie.org; extra commands get a "slow down" reply
+CHAT_RATE_PER_MINUTE = float(os.getenv("CHAT_RATE_PER_MINUTE", "20"))
+CHAT_BURST = float(os.getenv("CHAT_BURST", "5"))
+CHAT_LIMITER_MAX_SIZE = int(os.getenv("CHAT_LIMITER_MAX_SIZE", "10000"))
+
+# Sessions (parsed cookies and pralnie.org user ids) kept in memory
+SESSION_REGISTRY_MAX_SIZE = int(os.getenv("SESSION_REGISTRY_MAX_SIZE", "10000"))
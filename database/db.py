@@ -1,7 +1,26 @@
+import asyncio
+import functools
 import logging
+import re
 import sqlite3
 import threading
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from config import DB_SYNCHRONOUS, DB_BUSY_TIMEOUT, DB_EXECUTOR_WORKERS
+from metrics.registry import REGISTRY, instrument
+
+logger = logging.getLogger(__name__)
+
+DB_CALL_SECONDS = REGISTRY.histogram("db_call_seconds", "Latency of UserDatabase methods", ["method"])
+DB_CALL_ERRORS = REGISTRY.counter("db_call_errors_total", "Exceptions raised by UserDatabase methods", ["method"])
+
+
+def instrumented(func):
+    """Records the latency and errors of a UserDatabase method."""
+    return instrument(DB_CALL_SECONDS, DB_CALL_ERRORS, method=func.__name__)(func)
 
 
 class SingletonMeta(type):
@@ -9,123 +28,385 @@ class SingletonMeta(type):
     _lock = threading.Lock()
 
     def __call__(cls, *args, **kwargs):
-        logging.debug("SingletonMeta __call__ starting")
+        logger.debug("SingletonMeta __call__ starting")
         with cls._lock:
             if cls._instance is None:
                 cls._instance = super(SingletonMeta, cls).__call__(*args, **kwargs)
-        logging.debug("SingletonMeta __call__ finished")
+        logger.debug("SingletonMeta __call__ finished")
         return cls._instance
 
 
+# Columns of the users table that can be written through upsert_user
+USER_FIELDS = ("cookies", "cookie_expires_at", "username", "password")
+
+# Prefix of the keys of transactions without an id, which hash the fields that identify them.
+# Older keys, "<sha1 of the whole transaction>:<occurrence>", are replaced by _migrate_transaction_keys.
+FIELDS_KEY_PREFIX = "fields:"
+WHOLE_ITEM_KEY_GLOB = "[0-9a-f]" * 40 + ":[0-9]*"
+
+# Format of the cookie expirations stored before they became epoch seconds
+LEGACY_EXPIRATION_FORMAT = "%Y-%m-%d %H:%M:%S UTC"
+
+# Transaction dates as "2024-03-15 12:00:00" (or any ISO 8601 date) or "15.03.2024 12:00"
+ISO_MONTH = re.compile(r"(\d{4})-(\d{2})")
+DOTTED_MONTH = re.compile(r"\d{1,2}\.(\d{1,2})\.(\d{4})")
+
+
+def month_of(created_at):
+    """Returns the "YYYY-MM" month of a transaction date, or None if the date is missing or not recognized."""
+    if not created_at:
+        return None
+    match = ISO_MONTH.match(created_at)
+    if match:
+        return f"{match[1]}-{match[2]}"
+    match = DOTTED_MONTH.match(created_at)
+    if match:
+        return f"{match[2]}-{int(match[1]):02d}"
+    return None
+
+
+class AsyncUserDatabase:
+    """
+    Awaitable view of UserDatabase: every method runs on the database executor,
+    so handlers can use the database without stalling the event loop.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        method = getattr(self._db, name)
+
+        async def run(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._db.executor, functools.partial(method, *args, **kwargs))
+
+        return run
+
+
 class UserDatabase(metaclass=SingletonMeta):
     def __init__(self, db_file='users.db'):
-        logging.debug("UserDatabase __init__ starting")
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
-        self.cursor = self.conn.cursor()
-        self.lock = threading.RLock()
+        logger.debug("UserDatabase __init__ starting")
+        self.db_file = db_file
+        self._local = threading.local()
+        # Thread -> its connection, for closing them
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+        self._write_listeners = []
+        self.executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+        self.aio = AsyncUserDatabase(self)
         self.initialize_db()
-        logging.debug("UserDatabase __init__ finished")
+        logger.debug("UserDatabase __init__ finished")
+
+    @property
+    def conn(self):
+        """
+        Returns the connection of the calling thread, opening it on first use.
+        Connections run in autocommit mode, writes open explicit transactions via transaction().
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+            self._local.conn = conn
+            with self._connections_lock:
+                # Threads that have exited never use their connection again
+                for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                    self._connections.pop(thread).close()
+                self._connections[threading.current_thread()] = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the enclosed statements in a single write transaction on the calling thread's connection.
+        The write lock is taken upfront, so concurrent writers wait instead of failing mid-transaction.
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
     def initialize_db(self):
-        """Creates a users table if it does not exist."""
-        logging.debug("initialize_db starting")
-        with self.lock:
-            self.cursor.execute('''
+        """
+        Creates the users, transactions, balances, monthly_spending, outbox and leases tables
+        if they do not exist and migrates older schemas and transaction keys.
+        """
+        logger.debug("initialize_db starting")
+        with self.transaction() as conn:
+            conn.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     chat_id INTEGER PRIMARY KEY,
                     cookies TEXT,
-                    cookie_expirations TEXT,
+                    cookie_expires_at INTEGER,
                     username TEXT,
                     password TEXT
                 )
             ''')
-            self.conn.commit()
-        logging.debug("initialize_db finished")
+            self._migrate_cookie_expirations(conn)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_users_cookie_expires_at ON users (cookie_expires_at)")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS transactions (
+                    chat_id INTEGER NOT NULL,
+                    transaction_id TEXT NOT NULL,
+                    created_at TEXT,
+                    value_cents INTEGER NOT NULL,
+                    PRIMARY KEY (chat_id, transaction_id)
+                )
+            ''')
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_transactions_chat_created ON transactions (chat_id, created_at)"
+            )
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS balances (
+                    chat_id INTEGER PRIMARY KEY,
+                    balance_cents INTEGER NOT NULL DEFAULT 0,
+                    transaction_count INTEGER NOT NULL DEFAULT 0,
+                    synced_at REAL,
+                    stale INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            self._migrate_balance_stale(conn)
+            self._create_monthly_spending(conn)
+            self._migrate_transaction_keys(conn)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    not_before REAL NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_not_before ON outbox (not_before)")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+        logger.debug("initialize_db finished")
+
+    @staticmethod
+    def _migrate_cookie_expirations(conn):
+        """Moves cookie expirations stored as text in older databases to the epoch cookie_expires_at column."""
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(users)")}
+        if "cookie_expires_at" in columns:
+            return
+        logger.info("Migrating cookie expirations to epoch seconds")
+        conn.execute("ALTER TABLE users ADD COLUMN cookie_expires_at INTEGER")
+        rows = conn.execute("SELECT chat_id, cookie_expirations FROM users WHERE cookie_expirations IS NOT NULL")
+        for row in rows.fetchall():
+            try:
+                expires = datetime.strptime(row['cookie_expirations'], LEGACY_EXPIRATION_FORMAT)
+            except ValueError as e:
+                logger.error("Error while parsing cookie expiration date for chat_id %s: %s", row['chat_id'], e)
+                continue
+            conn.execute(
+                "UPDATE users SET cookie_expires_at = ? WHERE chat_id = ?",
+                (int(expires.replace(tzinfo=timezone.utc).timestamp()), row['chat_id'])
+            )
+
+    @staticmethod
+    def _migrate_balance_stale(conn):
+        """Adds the stale flag to balances tables created before it, which expired balances by clearing synced_at."""
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(balances)")}
+        if "stale" not in columns:
+            logger.info("Adding the stale flag to stored balances")
+            conn.execute("ALTER TABLE balances ADD COLUMN stale INTEGER NOT NULL DEFAULT 0")
+
+    @staticmethod
+    def _create_monthly_spending(conn):
+        """
+        Creates the per-user, per-month aggregates of the transactions: top-ups (positive values) and
+        washes (negative values, stored as positive amounts spent). Rows are kept current by add_transactions,
+        the table is filled from the stored transactions when it is first created.
+        """
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'monthly_spending'"
+        ).fetchone()
+        if exists:
+            return
+        conn.execute('''
+            CREATE TABLE monthly_spending (
+                chat_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                topup_count INTEGER NOT NULL DEFAULT 0,
+                topup_cents INTEGER NOT NULL DEFAULT 0,
+                wash_count INTEGER NOT NULL DEFAULT 0,
+                wash_cents INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, month)
+            ) WITHOUT ROWID
+        ''')
+        totals = {}
+        for row in conn.execute("SELECT chat_id, created_at, value_cents FROM transactions"):
+            month = month_of(row['created_at'])
+            if month is not None:
+                UserDatabase._add_to_month(totals, (row['chat_id'], month), row['value_cents'])
+        if totals:
+            logger.info("Computing monthly spending of %s user months from stored transactions", len(totals))
+            UserDatabase._write_monthly_spending(conn, totals)
+
+    @staticmethod
+    def _migrate_transaction_keys(conn):
+        """
+        Drops the transactions stored under keys hashing the whole transaction, which changed whenever
+        any field did, from the running balances and monthly_spending. Their balances are marked stale,
+        so the next sync stores them again under keys from their identifying fields.
+        """
+        rows = conn.execute(
+            "SELECT chat_id, created_at, value_cents FROM transactions WHERE transaction_id GLOB ?",
+            (WHOLE_ITEM_KEY_GLOB,)
+        ).fetchall()
+        if not rows:
+            return
+        logger.info("Re-keying %s stored transactions without an id", len(rows))
+        balances = {}
+        months = {}
+        for row in rows:
+            cents, count = balances.get(row['chat_id'], (0, 0))
+            balances[row['chat_id']] = (cents + row['value_cents'], count + 1)
+            month = month_of(row['created_at'])
+            if month is not None:
+                UserDatabase._add_to_month(months, (row['chat_id'], month), row['value_cents'])
+        conn.executemany(
+            "UPDATE balances SET balance_cents = balance_cents - ?, transaction_count = transaction_count - ?, "
+            "stale = 1 WHERE chat_id = ?",
+            ((cents, count, chat_id) for chat_id, (cents, count) in balances.items())
+        )
+        UserDatabase._write_monthly_spending(
+            conn, {key: tuple(-total for total in totals) for key, totals in months.items()}
+        )
+        conn.execute("DELETE FROM transactions WHERE transaction_id GLOB ?", (WHOLE_ITEM_KEY_GLOB,))
+
+    @staticmethod
+    def _add_to_month(totals, key, value_cents):
+        topup_count, topup_cents, wash_count, wash_cents = totals.get(key, (0, 0, 0, 0))
+        if value_cents >= 0:
+            totals[key] = (topup_count + 1, topup_cents + value_cents, wash_count, wash_cents)
+        else:
+            totals[key] = (topup_count, topup_cents, wash_count + 1, wash_cents - value_cents)
+
+    @staticmethod
+    def _write_monthly_spending(conn, totals):
+        conn.executemany(
+            "INSERT INTO monthly_spending (chat_id, month, topup_count, topup_cents, wash_count, wash_cents) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (chat_id, month) DO UPDATE SET "
+            "topup_count = topup_count + excluded.topup_count, "
+            "topup_cents = topup_cents + excluded.topup_cents, "
+            "wash_count = wash_count + excluded.wash_count, "
+            "wash_cents = wash_cents + excluded.wash_cents",
+            ((chat_id, month, *counts) for (chat_id, month), counts in totals.items())
+        )
+
+    @instrumented
+    def upsert_user(self, chat_id, **fields):
+        """
+        Inserts the user with the given chat_id or updates the given fields of an existing one
+        in a single statement.
+        """
+        unknown = set(fields) - set(USER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+        logger.debug("upsert_user starting for chat_id %s", chat_id)
+        with self.transaction() as conn:
+            self._upsert(conn, chat_id, fields)
+        self._notify_write_listeners({chat_id: fields})
+        logger.debug("upsert_user finished for chat_id %s", chat_id)
+
+    @staticmethod
+    def _upsert(conn, chat_id, fields):
+        if not fields:
+            conn.execute("INSERT OR IGNORE INTO users (chat_id) VALUES (?)", (chat_id,))
+            return
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        updates = ", ".join(f"{column} = excluded.{column}" for column in fields)
+        conn.execute(
+            f"INSERT INTO users (chat_id, {columns}) VALUES (?, {placeholders}) "
+            f"ON CONFLICT (chat_id) DO UPDATE SET {updates}",
+            (chat_id, *fields.values())
+        )
 
+    def add_write_listener(self, listener):
+        """
+        Registers listener(chat_id, fields), called with the written fields after every committed
+        upsert_user or set_* write, on the writing thread. Used to keep in-memory copies of users current.
+        """
+        self._write_listeners.append(listener)
+
+    def _notify_write_listeners(self, changes):
+        for listener in self._write_listeners:
+            for chat_id, fields in changes.items():
+                try:
+                    listener(chat_id, fields)
+                except Exception as e:
+                    logger.error("Write listener %r failed for chat_id %s: %s", listener, chat_id, e)
+
+    @instrumented
     def get_user(self, chat_id):
         """Retrieves all the data of a user with a given chat_id."""
-        logging.debug(f"get_user starting for chat_id {chat_id}")
-        with self.lock:
-            self.cursor.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
-            result = self.cursor.fetchone()
-        logging.debug(f"get_user finished for chat_id {chat_id}")
+        logger.debug("get_user starting for chat_id %s", chat_id)
+        result = self.conn.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        logger.debug("get_user finished for chat_id %s", chat_id)
         return result
 
     def set_cookies(self, chat_id, cookies):
         """
         Sets cookies for the user with the specified chat_id.
         """
-        logging.debug(f"set_cookies starting for chat_id {chat_id}")
-        with self.lock:
-            if self.get_user(chat_id) is None:
-                self.cursor.execute("INSERT INTO users (chat_id, cookies) VALUES (?, ?)", (chat_id, cookies))
-            else:
-                self.cursor.execute("UPDATE users SET cookies = ? WHERE chat_id = ?", (cookies, chat_id))
-            self.conn.commit()
-        logging.debug(f"set_cookies finished for chat_id {chat_id}")
+        self.upsert_user(chat_id, cookies=cookies)
 
+    @instrumented
     def get_cookies(self, chat_id):
         """
         Gets cookies for the user with the specified chat_id.
         """
-        logging.debug(f"get_cookies starting for chat_id {chat_id}")
-        with self.lock:
-            self.cursor.execute("SELECT cookies FROM users WHERE chat_id = ?", (chat_id,))
-            result = self.cursor.fetchone()
-        logging.debug(f"get_cookies finished for chat_id {chat_id}")
+        logger.debug("get_cookies starting for chat_id %s", chat_id)
+        result = self.conn.execute("SELECT cookies FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        logger.debug("get_cookies finished for chat_id %s", chat_id)
         return result['cookies'] if result else None
 
-    def set_cookie_expirations(self, chat_id, expiration_time):
+    def set_cookie_expirations(self, chat_id, expires_at):
         """
-        Sets the cookie expiration time for the user with the specified chat_id.
+        Sets the cookie expiration time (epoch seconds) for the user with the specified chat_id.
         """
-        logging.debug(f"set_cookie_expirations starting for chat_id {chat_id}")
-        with self.lock:
-            if self.get_user(chat_id) is None:
-                self.cursor.execute("INSERT INTO users (chat_id, cookie_expirations) VALUES (?, ?)",
-                                    (chat_id, expiration_time))
-            else:
-                self.cursor.execute("UPDATE users SET cookie_expirations = ? WHERE chat_id = ?",
-                                    (expiration_time, chat_id))
-            self.conn.commit()
-        logging.debug(f"set_cookie_expirations finished for chat_id {chat_id}")
+        self.upsert_user(chat_id, cookie_expires_at=int(expires_at))
 
+    @instrumented
     def get_cookie_expirations(self, chat_id):
         """
-        Gets the cookie expiration time for the user with the specified chat_id.
+        Gets the cookie expiration time (epoch seconds) for the user with the specified chat_id.
         """
-        logging.debug(f"get_cookie_expirations starting for chat_id {chat_id}")
-        with self.lock:
-            self.cursor.execute("SELECT cookie_expirations FROM users WHERE chat_id = ?", (chat_id,))
-            result = self.cursor.fetchone()
-        logging.debug(f"get_cookie_expirations finished for chat_id {chat_id}")
-        return result['cookie_expirations'] if result else None
+        logger.debug("get_cookie_expirations starting for chat_id %s", chat_id)
+        result = self.conn.execute("SELECT cookie_expires_at FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        logger.debug("get_cookie_expirations finished for chat_id %s", chat_id)
+        return result['cookie_expires_at'] if result else None
 
     def set_username(self, chat_id, username):
         """
         Sets the username for the user with the given chat_id.
         """
-        logging.debug(f"set_username starting for chat_id {chat_id}")
-        with self.lock:
-            if self.get_user(chat_id) is None:
-                self.cursor.execute("INSERT INTO users (chat_id, username) VALUES (?, ?)", (chat_id, username))
-                logging.info(f"Inserted new user with chat_id {chat_id} and username {username}")
-            else:
-                self.cursor.execute("UPDATE users SET username = ? WHERE chat_id = ?", (username, chat_id))
-                logging.info(f"Updated username for chat_id {chat_id} to {username}")
-            self.conn.commit()
-        logging.debug(f"set_username finished for chat_id {chat_id}")
+        self.upsert_user(chat_id, username=username)
 
+    @instrumented
     def get_username(self, chat_id):
         """
         Gets the username for the user with the given chat_id.
         """
-        logging.debug(f"get_username starting for chat_id {chat_id}")
-        with self.lock:
-            self.cursor.execute("SELECT username FROM users WHERE chat_id = ?", (chat_id,))
-            result = self.cursor.fetchone()
-        logging.debug(f"get_username finished for chat_id {chat_id}")
+        logger.debug("get_username starting for chat_id %s", chat_id)
+        result = self.conn.execute("SELECT username FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        logger.debug("get_username finished for chat_id %s", chat_id)
         return result['username'] if result else None
 
     def set_password(self, chat_id, password):
@@ -133,54 +414,233 @@ class UserDatabase(metaclass=SingletonMeta):
         Sets the password for the user with the given chat_id.
         We store the password in plaintext.
         """
-        logging.debug(f"set_password starting for chat_id {chat_id}")
-        with self.lock:
-            if self.get_user(chat_id) is None:
-                self.cursor.execute("INSERT INTO users (chat_id, password) VALUES (?, ?)", (chat_id, password))
-            else:
-                self.cursor.execute("UPDATE users SET password = ? WHERE chat_id = ?", (password, chat_id))
-            self.conn.commit()
-        logging.debug(f"set_password finished for chat_id {chat_id}")
+        self.upsert_user(chat_id, password=password)
 
+    @instrumented
     def get_password(self, chat_id):
         """
         Gets the password for the user with the given chat_id.
         """
-        logging.debug(f"get_password starting for chat_id {chat_id}")
-        with self.lock:
-            self.cursor.execute("SELECT password FROM users WHERE chat_id = ?", (chat_id,))
-            result = self.cursor.fetchone()
-        logging.debug(f"get_password finished for chat_id {chat_id}")
+        logger.debug("get_password starting for chat_id %s", chat_id)
+        result = self.conn.execute("SELECT password FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        logger.debug("get_password finished for chat_id %s", chat_id)
         return result['password'] if result else None
 
-    def get_users_data(self):
+    @instrumented
+    def get_users_due_before(self, ts, limit=None):
         """
-        Retrieves all user data (chat_id, username, password, cookie_expirations) and returns a list sorted by
-        expiration date.
+        Retrieves the users (chat_id, username, password, cookie_expires_at) whose cookies expire
+        at or before the epoch timestamp ts, ordered by expiration time, using the expiration index.
         """
-        query = "SELECT chat_id, username, password, cookie_expirations FROM users"
-        self.cursor.execute(query)
-        rows = self.cursor.fetchall()
-        users = []
-        for row in rows:
-            exp_str = row['cookie_expirations']
-            try:
-                exp_date = datetime.strptime(exp_str, "%Y-%m-%d %H:%M:%S UTC")
-            except Exception as e:
-                logging.error(f"Error while parsing cookie expiration date for chat_id {row['chat_id']}: {e}")
-                continue
-            users.append({
-                'chat_id': row['chat_id'],
-                'username': row['username'],
-                'password': row['password'],
-                'cookie_expirations': exp_date
-            })
-        users.sort(key=lambda u: u['cookie_expirations'])
-        return users
+        logger.debug("get_users_due_before starting for %s", ts)
+        rows = self.conn.execute(
+            "SELECT chat_id, username, password, cookie_expires_at FROM users "
+            "WHERE cookie_expires_at <= ? ORDER BY cookie_expires_at LIMIT ?",
+            (ts, -1 if limit is None else limit)
+        ).fetchall()
+        logger.debug("get_users_due_before finished for %s, %s users", ts, len(rows))
+        return rows
+
+    @instrumented
+    def add_transactions(self, chat_id, transactions, synced_at):
+        """
+        Stores the transactions of the user with the given chat_id, skipping the ones already known,
+        and adds the new ones to the running balance and their month in monthly_spending.
+        transactions is an iterable of (transaction_id, created_at, value_cents) tuples.
+        Returns the number of new transactions.
+        """
+        logger.debug("add_transactions starting for chat_id %s", chat_id)
+        with self.transaction() as conn:
+            added = 0
+            delta_cents = 0
+            months = {}
+            for transaction_id, created_at, value_cents in transactions:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO transactions (chat_id, transaction_id, created_at, value_cents) "
+                    "VALUES (?, ?, ?, ?)",
+                    (chat_id, transaction_id, created_at, value_cents)
+                )
+                if cursor.rowcount:
+                    added += 1
+                    delta_cents += value_cents
+                    month = month_of(created_at)
+                    if month is not None:
+                        self._add_to_month(months, (chat_id, month), value_cents)
+            if months:
+                self._write_monthly_spending(conn, months)
+            conn.execute(
+                "INSERT INTO balances (chat_id, balance_cents, transaction_count, synced_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET "
+                "balance_cents = balance_cents + excluded.balance_cents, "
+                "transaction_count = transaction_count + excluded.transaction_count, "
+                "synced_at = excluded.synced_at, stale = 0",
+                (chat_id, delta_cents, added, synced_at)
+            )
+        logger.debug("add_transactions finished for chat_id %s, %s new", chat_id, added)
+        return added
+
+    @instrumented
+    def get_balance(self, chat_id):
+        """
+        Gets the running balance (balance_cents, transaction_count, synced_at, stale) for the user
+        with the given chat_id. stale is 1 once the balance is known to be outdated.
+        """
+        logger.debug("get_balance starting for chat_id %s", chat_id)
+        result = self.conn.execute(
+            "SELECT balance_cents, transaction_count, synced_at, stale FROM balances WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        logger.debug("get_balance finished for chat_id %s", chat_id)
+        return result
+
+    @instrumented
+    def get_monthly_spending(self, chat_id, before=None, after=None, limit=12):
+        """
+        Gets up to limit months (month, topup_count, topup_cents, wash_count, wash_cents) of the user
+        with the given chat_id, newest first. Pages are read by keyset from the primary key: months
+        older than before, or the months closest to and newer than after.
+        """
+        logger.debug("get_monthly_spending starting for chat_id %s", chat_id)
+        columns = "month, topup_count, topup_cents, wash_count, wash_cents"
+        if after is not None:
+            rows = self.conn.execute(
+                f"SELECT {columns} FROM monthly_spending WHERE chat_id = ? AND month > ? ORDER BY month LIMIT ?",
+                (chat_id, after, limit)
+            ).fetchall()
+            rows.reverse()
+        else:
+            rows = self.conn.execute(
+                f"SELECT {columns} FROM monthly_spending WHERE chat_id = ? AND month < ? "
+                "ORDER BY month DESC LIMIT ?",
+                # "~" sorts after any "YYYY-MM" month
+                (chat_id, "~" if before is None else before, limit)
+            ).fetchall()
+        logger.debug("get_monthly_spending finished for chat_id %s, %s months", chat_id, len(rows))
+        return rows
+
+    @instrumented
+    def expire_balance(self, chat_id):
+        """
+        Marks the stored balance of the user with the given chat_id as outdated.
+        It keeps its synced_at, so that it can still be shown as the last known balance.
+        """
+        logger.debug("expire_balance starting for chat_id %s", chat_id)
+        with self.transaction() as conn:
+            conn.execute("UPDATE balances SET stale = 1 WHERE chat_id = ?", (chat_id,))
+        logger.debug("expire_balance finished for chat_id %s", chat_id)
+
+    @instrumented
+    def get_logged_in_chat_ids(self):
+        """
+        Retrieves the chat_ids of all users with stored session cookies.
+        """
+        logger.debug("get_logged_in_chat_ids starting")
+        rows = self.conn.execute("SELECT chat_id FROM users WHERE cookies IS NOT NULL ORDER BY chat_id").fetchall()
+        logger.debug("get_logged_in_chat_ids finished, %s users", len(rows))
+        return [row['chat_id'] for row in rows]
+
+    @instrumented
+    def enqueue_messages(self, messages, created_at=None):
+        """
+        Stores outgoing messages, an iterable of (chat_id, text) tuples, in one transaction.
+        Returns the number of messages stored.
+        """
+        created_at = time.time() if created_at is None else created_at
+        logger.debug("enqueue_messages starting")
+        with self.transaction() as conn:
+            cursor = conn.executemany(
+                "INSERT INTO outbox (chat_id, text, created_at) VALUES (?, ?, ?)",
+                ((chat_id, text, created_at) for chat_id, text in messages)
+            )
+        logger.debug("enqueue_messages finished, %s messages", cursor.rowcount)
+        return cursor.rowcount
+
+    @instrumented
+    def get_due_messages(self, now, limit):
+        """
+        Retrieves up to limit outgoing messages (id, chat_id, text, created_at, attempts) that may be sent at now,
+        oldest first.
+        """
+        logger.debug("get_due_messages starting")
+        rows = self.conn.execute(
+            "SELECT id, chat_id, text, created_at, attempts FROM outbox WHERE not_before <= ? ORDER BY id LIMIT ?",
+            (now, limit)
+        ).fetchall()
+        logger.debug("get_due_messages finished, %s messages", len(rows))
+        return rows
+
+    @instrumented
+    def get_next_message_time(self):
+        """
+        Returns the earliest time at which an outgoing message may be sent, or None if there are none.
+        """
+        result = self.conn.execute("SELECT MIN(not_before) AS not_before FROM outbox").fetchone()
+        return result['not_before']
+
+    @instrumented
+    def count_messages(self):
+        """
+        Returns the number of outgoing messages waiting to be sent.
+        """
+        return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    @instrumented
+    def delete_messages(self, message_ids):
+        """
+        Removes outgoing messages that were delivered or given up on.
+        """
+        logger.debug("delete_messages starting for %s messages", len(message_ids))
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM outbox WHERE id = ?", ((message_id,) for message_id in message_ids))
+        logger.debug("delete_messages finished")
+
+    @instrumented
+    def postpone_message(self, message_id, not_before, attempts):
+        """
+        Records a failed delivery attempt of an outgoing message and when to try it again.
+        """
+        logger.debug("postpone_message starting for message %s", message_id)
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE outbox SET not_before = ?, attempts = ? WHERE id = ?", (not_before, attempts, message_id)
+            )
+        logger.debug("postpone_message finished for message %s", message_id)
+
+    @instrumented
+    def try_acquire_lease(self, name, holder, ttl, now=None):
+        """
+        Takes or renews the lease with the given name for holder until now + ttl.
+        Succeeds if the lease is free, expired or already held by holder; returns whether holder has it.
+        """
+        now = time.time() if now is None else now
+        logger.debug("try_acquire_lease starting for %s by %s", name, holder)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, holder, now + ttl, now)
+            )
+            result = conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        logger.debug("try_acquire_lease finished for %s, held by %s", name, result['holder'])
+        return result['holder'] == holder
+
+    @instrumented
+    def release_lease(self, name, holder):
+        """
+        Gives up the lease with the given name if holder has it, so another process can take it over at once.
+        """
+        logger.debug("release_lease starting for %s by %s", name, holder)
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+        logger.debug("release_lease finished for %s", name)
 
     def close(self):
-        """Close connection to db"""
-        logging.debug("close starting")
-        with self.lock:
-            self.conn.close()
-        logging.debug("close finished")
+        """Close all connections to db and stop the database executor"""
+        logger.debug("close starting")
+        self.executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+        logger.debug("close finished")
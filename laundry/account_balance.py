@@ -1,88 +1,192 @@
-import re
-import urllib.parse
-
-import requests
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
 from config import PRALNIE_BASE_TRANSACTIONS_URL
-from database.db import UserDatabase
+from database.db import FIELDS_KEY_PREFIX, UserDatabase
+from laundry import client
+from laundry.admission import background_priority
+from laundry.balance_cache import CachedBalance, balance_cache
+from laundry.circuit import CircuitOpen, get_breaker
+from laundry.cookies import SessionExpired, is_logged_out, with_relogin
+from laundry.json_stream import iter_json_array
+from laundry.sessions import get_session
+from laundry.singleflight import flights
 
+logger = logging.getLogger(__name__)
 
-def get_transactions_sum(chat_id: int):
-    """
-    This function retrieves the user's cookies, decodes the session cookie,
-    extracts the user ID, fetches the transaction list, and sums the "Value" fields.
-    """
-    db = UserDatabase()
-    cookie_data = db.get_cookies(chat_id)
-    if not cookie_data:
-        return None
+# Background refreshes in flight, keyed by chat_id
+_revalidations = {}
 
-    # Split cookies into individual key=value pairs
-    cookies = {}
-    for cookie in cookie_data.split(";"):
-        cookie = cookie.strip()
-        if "=" in cookie:
-            key, value = cookie.split("=", 1)
-            cookies[key] = value
-
-    # Find the cookie that is NOT PHPSESSID (assuming it's our session cookie)
-    user_cookie_key = None
-    for key in cookies:
-        if key != "PHPSESSID":
-            user_cookie_key = key
-            break
-
-    if user_cookie_key is None:
-        raise ValueError("User session cookie not found.")
-
-    # Retrieve the encoded cookie value and perform URL decoding
-    encoded_cookie = cookies[user_cookie_key]
-    decoded_cookie = urllib.parse.unquote(encoded_cookie)
-
-    # Split the hash prefix from session data – split only at the first colon
-    try:
-        hash_prefix, session_data = decoded_cookie.split(":", 1)
-    except ValueError:
-        raise ValueError("Error while splitting session data. Check the input format.")
+# Keys under which the laundry service may report a transaction's id and date
+TRANSACTION_ID_KEYS = ("Id", "ID", "id", "TransactionId")
+TRANSACTION_DATE_KEYS = ("Date", "CreatedAt", "date", "created_at")
+TRANSACTION_TYPE_KEYS = ("Type", "TransactionType", "type")
 
-    # Remove any numerical prefix from session data
-    session_data_clean = re.sub(r"^\d+:", "", session_data, count=1)
+# Number of streamed transactions written to the database at once
+SYNC_BATCH_SIZE = 500
 
-    # Parse data in PHP session format
-    matches = re.findall(
-        r"i:(\d+);(?:s:(\d+):\"([^\"]*)\"|i:(\d+);|a:(\d+):\{\})",
-        session_data_clean
-    )
 
-    parsed_data = {}
-    for match in matches:
-        key = int(match[0])
-        if match[1]:  # Text value
-            parsed_data[key] = match[2]
-        elif match[3]:  # Integer value
-            parsed_data[key] = int(match[3])
-        elif match[4]:  # Empty array – treat it as an empty list
-            parsed_data[key] = []
-
-    # Determine user ID – the first element (index 0)
-    user_id = parsed_data.get(0)
+def _to_cents(value) -> int:
+    """Converts a transaction value to integer grosze without float rounding errors."""
+    return int((Decimal(str(value)) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def format_cents(cents: int) -> str:
+    """Formats an amount in grosze the way balances are shown to the user."""
+    return "{:.2f}".format(Decimal(cents) / 100)
+
+
+def _transaction_row(item, occurrences):
+    """
+    Returns (transaction_id, created_at, value_cents) for a transaction, or None if its value is missing
+    or not a number. Transactions without an id are identified by a hash of their date, value and type
+    and its occurrence number, counted in occurrences.
+    """
+    try:
+        value_cents = _to_cents(item.get("Value", 0))
+    except InvalidOperation:
+        # Skipped rather than counted as 0, so it is stored once the service reports its value
+        logger.warning("Skipping a transaction with an invalid value: %r", item.get("Value"))
+        return None
+    transaction_id = next((str(item[key]) for key in TRANSACTION_ID_KEYS if item.get(key) is not None), None)
+    created_at = next((str(item[key]) for key in TRANSACTION_DATE_KEYS if item.get(key) is not None), None)
+    if transaction_id is None:
+        # Other fields such as the description or status may change without making it a new transaction
+        kind = next((str(item[key]) for key in TRANSACTION_TYPE_KEYS if item.get(key) is not None), None)
+        digest = hashlib.sha1(json.dumps([created_at, value_cents, kind]).encode()).hexdigest()
+        occurrences[digest] = occurrences.get(digest, 0) + 1
+        transaction_id = f"{FIELDS_KEY_PREFIX}{digest}:{occurrences[digest]}"
+    return transaction_id, created_at, value_cents
+
+
+async def sync_transactions(chat_id: int, transactions) -> str:
+    """
+    Stores new transactions from an async iterator in the local database, in batches of
+    SYNC_BATCH_SIZE, and returns the updated running balance.
+    """
+    db = UserDatabase()
+    occurrences = {}
+    batch = []
+    added = 0
+    async for item in transactions:
+        row = _transaction_row(item, occurrences)
+        if row is not None:
+            batch.append(row)
+        if len(batch) >= SYNC_BATCH_SIZE:
+            added += await db.aio.add_transactions(chat_id, batch, time.time())
+            batch = []
+    # The last call also records the sync for users without any (new) transactions
+    added += await db.aio.add_transactions(chat_id, batch, time.time())
+    balance_cents = (await db.aio.get_balance(chat_id))['balance_cents']
+    logger.info("Synced transactions for chat_id %s: %s new", chat_id, added)
+    return format_cents(balance_cents)
+
+
+async def get_transactions_sum(chat_id: int):
+    """
+    This function takes the user's session from the session registry, fetches the transaction
+    list of its pralnie.org user ID, and syncs it into the local transactions table,
+    returning the running balance.
+    """
+    session = await get_session(chat_id)
+    if session is None:
+        return None
+    cookie_data = session.cookie_data
+    user_id = session.user_id
     if user_id is None:
         raise ValueError("Failed to extract user ID from the cookie.")
 
     # Fetch the transaction list for the given user ID
     url = f"{PRALNIE_BASE_TRANSACTIONS_URL}/{user_id}"
     headers = {"Cookie": cookie_data}  # Pass the original cookies
-    response = requests.get(url, headers=headers)
+    async with client.stream("transactions", "GET", url, headers=headers) as response:
+        # Check if the response returned an OK status
+        if is_logged_out(response):
+            raise SessionExpired(chat_id, cookie_data)
+        if response.status_code != 200:
+            raise client.UpstreamError(f"Error fetching data: {response.status_code}")
+
+        # The list is parsed as it arrives, only transactions not seen before are added to the running balance
+        try:
+            return await sync_transactions(chat_id, iter_json_array(response.aiter_bytes()))
+        except ValueError:
+            raise client.UpstreamError("Server response is not valid JSON.") from None
+
+
+async def refresh_balance(chat_id: int):
+    """
+    Fetches the balance from the laundry service and stores it in the balance cache.
+    Concurrent refreshes for the same chat_id share a single upstream call,
+    and an expired session is renewed transparently.
+    """
+    balance = await flights.do(
+        ("balance", chat_id),
+        lambda: with_relogin(chat_id, lambda: get_transactions_sum(chat_id))
+    )
+    if balance is not None:
+        balance_cache.set(chat_id, balance)
+    return balance
 
-    # Check if the response returned an OK status
-    if response.status_code != 200:
-        raise Exception(f"Error fetching data: {response.status_code}")
 
+async def _revalidate(chat_id: int):
     try:
-        transactions = response.json()
-    except ValueError:
-        raise ValueError("Server response is not valid JSON.")
+        await refresh_balance(chat_id)
+    except Exception as e:
+        logger.error("Background balance refresh failed for chat_id %s: %s", chat_id, e)
+    finally:
+        _revalidations.pop(chat_id, None)
+
+
+async def invalidate_balance(chat_id: int):
+    """
+    Forces the next balance lookup for chat_id to go to the laundry service.
+    """
+    balance_cache.invalidate(chat_id)
+    await UserDatabase().aio.expire_balance(chat_id)
+
+
+async def _load_stored_balance(chat_id: int):
+    """Seeds the balance cache from the running balance stored in the database."""
+    stored = await UserDatabase().aio.get_balance(chat_id)
+    if stored is None or stored['synced_at'] is None or stored['stale']:
+        return None
+    balance_cache.set(chat_id, format_cents(stored['balance_cents']), fetched_at=stored['synced_at'])
+    return balance_cache.get(chat_id)
+
 
-    # Sum all "Value" fields (assuming they are numeric)
-    total_sum = "{:.2f}".format(round(sum(item.get("Value", 0) for item in transactions), 2))
-    return total_sum
+async def get_balance(chat_id: int):
+    """
+    Returns the user's balance from the cache or the stored running balance when possible.
+    A stale entry is returned immediately while a refresh runs in the background,
+    a missing entry is fetched from the laundry service. Raises CircuitOpen instead of
+    returning a stale entry while the laundry service is unavailable.
+    """
+    entry = balance_cache.get(chat_id) or await _load_stored_balance(chat_id)
+    if entry is None:
+        return await refresh_balance(chat_id)
+    if not balance_cache.is_fresh(entry) and not get_breaker("transactions").available:
+        # Let the caller say that the balance may be out of date
+        raise CircuitOpen("transactions", get_breaker("transactions").retry_in)
+    if not balance_cache.is_fresh(entry) and chat_id not in _revalidations:
+        # The user already has an answer, so the refresh does not need to jump the queue
+        with background_priority():
+            _revalidations[chat_id] = asyncio.create_task(_revalidate(chat_id))
+    return entry.value
+
+
+async def get_last_known_balance(chat_id: int):
+    """
+    Returns the most recent balance known for chat_id, however old, as a CachedBalance
+    (value and fetched_at), or None if it was never fetched. Used while the laundry service is down.
+    """
+    entry = balance_cache.peek(chat_id)
+    if entry is not None:
+        return entry
+    stored = await UserDatabase().aio.get_balance(chat_id)
+    if stored is None or stored['synced_at'] is None:
+        return None
+    return CachedBalance(format_cents(stored['balance_cents']), stored['synced_at'])
@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from config import (
+    WORKERS,
+    UPSTREAM_MAX_CONCURRENT,
+    UPSTREAM_RATE_PER_SECOND,
+    UPSTREAM_BURST,
+    CHAT_RATE_PER_MINUTE,
+    CHAT_BURST,
+    CHAT_LIMITER_MAX_SIZE,
+)
+from laundry.ratelimit import TokenBucket
+from metrics.registry import REGISTRY
+
+# Priority classes, lower is served first
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+_priority = ContextVar("upstream_priority", default=INTERACTIVE)
+_shared = ContextVar("shared_priority", default=None)
+
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "admission_wait_seconds", "Time upstream requests waited for admission", ["priority"]
+)
+ADMISSION_REJECTED = REGISTRY.counter(
+    "admission_rejected_total", "Commands rejected before reaching pralnie.org", ["reason"]
+)
+
+
+@contextmanager
+def background_priority():
+    """Marks the upstream requests made inside the block, and in tasks started from it, as background traffic."""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class SharedPriority:
+    """
+    Priority of a call made on behalf of several callers (see laundry.singleflight), which can be
+    raised while the call runs when a more urgent caller joins it.
+    """
+
+    __slots__ = ("priority",)
+
+    def __init__(self, priority: int):
+        self.priority = priority
+
+
+def get_shared_priority() -> SharedPriority:
+    """Returns the shared priority the current task follows, or a new one at its current priority."""
+    return _shared.get() or SharedPriority(current_priority())
+
+
+def use_shared_priority(shared: SharedPriority):
+    """Makes the upstream requests of the current task follow shared, on top of its own priority."""
+    _shared.set(shared)
+
+
+def current_priority() -> int:
+    shared = _shared.get()
+    priority = _priority.get()
+    return priority if shared is None else min(priority, shared.priority)
+
+
+class AdmissionController:
+    """
+    Admits upstream requests within a concurrency cap and a requests-per-second budget.
+    Requests that cannot start right away wait in a priority queue: interactive requests
+    go ahead of background ones, requests of the same class are served in arrival order.
+    """
+
+    def __init__(self, max_concurrent=UPSTREAM_MAX_CONCURRENT, rate_per_second=UPSTREAM_RATE_PER_SECOND,
+                 burst=UPSTREAM_BURST):
+        self.max_concurrent = max_concurrent
+        self._bucket = TokenBucket(rate_per_second, burst)
+        self._active = 0
+        # [priority, sequence number, future, SharedPriority or None] of the requests waiting for admission
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._timer = None
+
+    def queued(self, priority: int) -> int:
+        return sum(1 for waiter in self._waiters if waiter[0] == priority and not waiter[2].done())
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _dispatch(self):
+        self._timer = None
+        while self._waiters and self._active < self.max_concurrent:
+            if self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._bucket.try_acquire():
+                self._timer = asyncio.get_running_loop().call_later(self._bucket.delay(), self._dispatch)
+                return
+            future = heapq.heappop(self._waiters)[2]
+            self._active += 1
+            future.set_result(None)
+
+    async def acquire(self, priority: int = None):
+        """Waits until the request may be sent. Every acquire() must be paired with a release()."""
+        priority = current_priority() if priority is None else priority
+        started = time.perf_counter()
+        if not self._waiters and self._active < self.max_concurrent and self._bucket.try_acquire():
+            self._active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, [priority, next(self._sequence), future, _shared.get()])
+            if self._timer is None:
+                self._dispatch()
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Admitted just before being cancelled: hand the slot to the next request
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, priority=PRIORITY_NAMES[priority])
+
+    def raise_priority(self, shared: SharedPriority, priority: int):
+        """Raises shared to priority, moving its requests that are already waiting ahead accordingly."""
+        if priority >= shared.priority:
+            return
+        shared.priority = priority
+        raised = False
+        for waiter in self._waiters:
+            if waiter[3] is shared and waiter[0] > priority:
+                waiter[0] = priority
+                raised = True
+        if raised:
+            heapq.heapify(self._waiters)
+
+    def release(self):
+        """Frees the slot of a finished request."""
+        self._active -= 1
+        if self._timer is None:
+            self._dispatch()
+
+
+class ChatLimiter:
+    """
+    Per-chat token buckets that reject commands beyond the allowed rate before they
+    reach the laundry service. Only the max_size most recently seen chats are tracked.
+    """
+
+    def __init__(self, rate_per_minute=CHAT_RATE_PER_MINUTE, burst=CHAT_BURST, max_size=CHAT_LIMITER_MAX_SIZE):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, chat_id: int) -> bool:
+        """Takes a token for chat_id; returns False if the chat is over its limit."""
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(self.rate, self.burst)
+                while len(self._buckets) > self.max_size:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(chat_id)
+            allowed = bucket.try_acquire()
+        if not allowed:
+            ADMISSION_REJECTED.inc(reason="chat_rate")
+        return allowed
+
+
+# Each worker process gets an equal share of the deployment-wide budget
+admission = AdmissionController(
+    max_concurrent=max(1, UPSTREAM_MAX_CONCURRENT // WORKERS),
+    rate_per_second=UPSTREAM_RATE_PER_SECOND / WORKERS,
+    burst=max(1.0, UPSTREAM_BURST / WORKERS),
+)
+chat_limiter = ChatLimiter()
+
+REGISTRY.gauge(
+    "admission", "Upstream requests in flight and waiting for admission by priority", ["stat"],
+    callback=lambda: {
+        ("active",): admission.active,
+        ("queued_interactive",): admission.queued(INTERACTIVE),
+        ("queued_background",): admission.queued(BACKGROUND),
+    }
+)
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+
+from config import BALANCE_CACHE_TTL, BALANCE_CACHE_MAX_STALE, BALANCE_CACHE_MAX_SIZE
+from metrics.registry import REGISTRY
+
+
+class CachedBalance:
+    __slots__ = ("value", "fetched_at")
+
+    def __init__(self, value, fetched_at):
+        self.value = value
+        self.fetched_at = fetched_at
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+
+class BalanceCache:
+    """
+    Bounded LRU cache of account balances keyed by chat_id.
+    Entries younger than ttl are fresh, entries younger than max_stale may be served
+    while a refresh runs in the background, older entries are treated as missing.
+    """
+
+    def __init__(self, ttl=BALANCE_CACHE_TTL, max_stale=BALANCE_CACHE_MAX_STALE, max_size=BALANCE_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, chat_id):
+        """Returns the cached entry for chat_id, or None if there is no usable one."""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None or entry.age > self.max_stale:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            if entry.age > self.ttl:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def peek(self, chat_id):
+        """Returns the cached entry for chat_id regardless of its age, without touching LRU order or stats."""
+        return self._entries.get(chat_id)
+
+    def is_fresh(self, entry):
+        return entry.age <= self.ttl
+
+    def set(self, chat_id, value, fetched_at=None):
+        """Stores a balance for chat_id, evicting the least recently used entries when full."""
+        with self._lock:
+            self._entries[chat_id] = CachedBalance(value, fetched_at or time.time())
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        """Drops the cached balance for chat_id."""
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def snapshot(self) -> list:
+        """Returns the cached entries as [chat_id, value, fetched_at] lists, least recently used first."""
+        with self._lock:
+            return [[chat_id, entry.value, entry.fetched_at] for chat_id, entry in self._entries.items()]
+
+    def restore(self, entries):
+        """Loads entries produced by snapshot(), skipping those already too old to be served."""
+        now = time.time()
+        for chat_id, value, fetched_at in entries:
+            if now - fetched_at <= self.max_stale:
+                self.set(chat_id, value, fetched_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+balance_cache = BalanceCache()
+
+REGISTRY.gauge(
+    "balance_cache", "Balance cache lookups by result and number of cached entries", ["stat"],
+    callback=lambda: {
+        ("hits",): balance_cache.hits,
+        ("stale_hits",): balance_cache.stale_hits,
+        ("misses",): balance_cache.misses,
+        ("size",): len(balance_cache),
+    }
+)
@@ -0,0 +1,145 @@
+import logging
+import time
+from collections import deque
+
+from config import (
+    CIRCUIT_WINDOW,
+    CIRCUIT_MIN_CALLS,
+    CIRCUIT_FAILURE_RATIO,
+    CIRCUIT_SLOW_CALL_SECONDS,
+    CIRCUIT_RESET_TIMEOUT,
+    CIRCUIT_HALF_OPEN_CALLS,
+)
+from metrics.registry import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_REJECTED = REGISTRY.counter(
+    "circuit_rejected_total", "Upstream calls rejected by an open circuit", ["operation"]
+)
+CIRCUIT_OPENED = REGISTRY.counter(
+    "circuit_opened_total", "Times a circuit opened", ["operation"]
+)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream operation whose circuit is open."""
+
+    def __init__(self, operation: str, retry_in: float):
+        super().__init__(f"Circuit for {operation} is open, retry in {retry_in:.0f} s")
+        self.operation = operation
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of the last window calls of one upstream operation. Once at least min_calls
+    are known and the share of failed or slower than slow_call_seconds calls reaches failure_ratio,
+    the circuit opens and calls fail fast with CircuitOpen for reset_timeout seconds. It then lets
+    up to half_open_calls trial calls through: a success closes it, a failure opens it again.
+    """
+
+    def __init__(self, operation: str, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS,
+                 failure_ratio=CIRCUIT_FAILURE_RATIO, slow_call_seconds=CIRCUIT_SLOW_CALL_SECONDS,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT, half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+        self.operation = operation
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        # True for each failed or slow call among the recent ones
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trials = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and self.retry_in <= 0:
+            return HALF_OPEN
+        return self._state
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until an open circuit lets trial calls through."""
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic()) if self._state == OPEN else 0.0
+
+    @property
+    def available(self) -> bool:
+        """Whether a call made now would be let through."""
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and self._trials < self.half_open_calls)
+
+    def before_call(self):
+        """Lets a call through or raises CircuitOpen. Every admitted call must be followed by one record_*() call."""
+        if self.state == HALF_OPEN:
+            if self._state == OPEN:
+                logger.info("Circuit for %s is half-open, sending trial calls", self.operation)
+                self._state = HALF_OPEN
+            if self._trials < self.half_open_calls:
+                self._trials += 1
+                return
+        elif self._state == CLOSED:
+            return
+        CIRCUIT_REJECTED.inc(operation=self.operation)
+        raise CircuitOpen(self.operation, max(self.retry_in, 1.0))
+
+    def record_success(self, seconds: float):
+        if seconds > self.slow_call_seconds:
+            self._record(failed=True)
+        else:
+            self._record(failed=False)
+
+    def record_failure(self):
+        self._record(failed=True)
+
+    def record_cancelled(self):
+        """Releases the slot of an admitted call that ended without an outcome."""
+        if self._state == HALF_OPEN:
+            self._trials = max(0, self._trials - 1)
+
+    def _record(self, failed: bool):
+        if self._state == HALF_OPEN:
+            self._trials = max(0, self._trials - 1)
+            if failed:
+                self._open()
+            else:
+                logger.info("Circuit for %s closed", self.operation)
+                self._state = CLOSED
+                self._outcomes.clear()
+            return
+        if self._state == OPEN:
+            # A call admitted before the circuit opened
+            return
+        self._outcomes.append(failed)
+        if len(self._outcomes) >= self.min_calls and sum(self._outcomes) >= self.failure_ratio * len(self._outcomes):
+            self._open()
+
+    def _open(self):
+        logger.warning("Circuit for %s opened for %g s", self.operation, self.reset_timeout)
+        CIRCUIT_OPENED.inc(operation=self.operation)
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._trials = 0
+        self._outcomes.clear()
+
+
+# Breakers by upstream operation name, created on first use
+circuit_breakers = {}
+
+
+def get_breaker(operation: str) -> CircuitBreaker:
+    breaker = circuit_breakers.get(operation)
+    if breaker is None:
+        breaker = circuit_breakers[operation] = CircuitBreaker(operation)
+    return breaker
+
+
+REGISTRY.gauge(
+    "circuit_state", "Circuit state by upstream operation: 0 closed, 1 half-open, 2 open", ["operation"],
+    callback=lambda: {(operation,): STATE_VALUES[breaker.state] for operation, breaker in circuit_breakers.items()}
+)
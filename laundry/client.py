@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+import httpx
+
+from config import (
+    PRALNIE_CONNECT_TIMEOUT,
+    PRALNIE_LOGIN_READ_TIMEOUT,
+    PRALNIE_TOPUP_READ_TIMEOUT,
+    PRALNIE_TRANSACTIONS_READ_TIMEOUT,
+    PRALNIE_MAX_CONNECTIONS,
+    PRALNIE_MAX_KEEPALIVE_CONNECTIONS,
+    PRALNIE_KEEPALIVE_EXPIRY,
+    PRALNIE_GET_RETRIES,
+    PRALNIE_RETRY_BACKOFF,
+)
+from laundry.admission import admission
+from laundry.circuit import get_breaker
+from metrics.registry import REGISTRY
+
+# h2 is installed through httpx[http2] in requirements.txt, environments without it fall back to HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Per-operation timeouts for the upstream calls
+OPERATION_TIMEOUTS = {
+    "login": httpx.Timeout(PRALNIE_LOGIN_READ_TIMEOUT, connect=PRALNIE_CONNECT_TIMEOUT),
+    "topup": httpx.Timeout(PRALNIE_TOPUP_READ_TIMEOUT, connect=PRALNIE_CONNECT_TIMEOUT),
+    "transactions": httpx.Timeout(PRALNIE_TRANSACTIONS_READ_TIMEOUT, connect=PRALNIE_CONNECT_TIMEOUT),
+}
+
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+
+class UpstreamError(Exception):
+    """Raised when pralnie.org answers, but with an error status or a response that cannot be used."""
+
+
+class ConnectionStats:
+    """Counts upstream requests and the connections opened to serve them."""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+
+    @property
+    def reuse_ratio(self):
+        """Share of requests served over an already open connection."""
+        if not self.requests:
+            return 0.0
+        return max(0.0, 1 - self.new_connections / self.requests)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reuse_ratio": round(self.reuse_ratio, 3),
+        }
+
+
+_client = None
+_stats = ConnectionStats()
+
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "upstream_request_seconds", "Latency of pralnie.org requests", ["operation", "status"]
+)
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "upstream_request_errors_total", "pralnie.org requests that failed without a response", ["operation", "error"]
+)
+REGISTRY.gauge(
+    "upstream_connections", "Upstream requests, opened connections and connection reuse ratio", ["stat"],
+    callback=lambda: {(name,): value for name, value in _stats.as_dict().items()}
+)
+
+
+def _build_client(transport=None) -> httpx.AsyncClient:
+    # Cookies are always passed explicitly per user, so the shared client must never remember them
+    cookie_jar = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+    limits = httpx.Limits(
+        max_connections=PRALNIE_MAX_CONNECTIONS,
+        max_keepalive_connections=PRALNIE_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=PRALNIE_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        limits=limits,
+        timeout=httpx.Timeout(PRALNIE_TRANSACTIONS_READ_TIMEOUT, connect=PRALNIE_CONNECT_TIMEOUT),
+        cookies=cookie_jar,
+        follow_redirects=False,
+        transport=transport,
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    """Returns the process-wide pooled client, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+
+def init_client(transport=None) -> httpx.AsyncClient:
+    """
+    Replaces the shared client, optionally with a custom transport
+    (used to point the bot at a stubbed or fake upstream).
+    """
+    global _client
+    _client = _build_client(transport)
+    return _client
+
+
+async def close_client():
+    """Closes the shared client and its pooled connections."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        logger.info("Upstream client closed: %s", _stats.as_dict())
+        _client = None
+
+
+def connection_stats() -> dict:
+    """Returns request and connection counters of the shared client."""
+    return _stats.as_dict()
+
+
+async def _trace(event_name, info):
+    if event_name == "connection.connect_tcp.complete":
+        _stats.new_connections += 1
+
+
+async def _send(operation: str, method: str, url: str, stream: bool, **kwargs) -> httpx.Response:
+    client = get_client()
+    kwargs.setdefault("timeout", OPERATION_TIMEOUTS[operation])
+    kwargs.setdefault("extensions", {"trace": _trace})
+    retries = PRALNIE_GET_RETRIES if method.upper() == "GET" else 0
+    breaker = get_breaker(operation)
+
+    for attempt in range(retries + 1):
+        # Fails fast with CircuitOpen while pralnie.org is known to be down
+        breaker.before_call()
+        try:
+            await admission.acquire()
+        except BaseException:
+            breaker.record_cancelled()
+            raise
+        _stats.requests += 1
+        started = time.perf_counter()
+        try:
+            response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+        except httpx.TransportError as e:
+            admission.release()
+            breaker.record_failure()
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, operation=operation, status="error")
+            UPSTREAM_ERRORS.inc(operation=operation, error=type(e).__name__)
+            if attempt >= retries:
+                raise
+            logger.warning("Upstream %s request failed (%r), retrying", operation, e)
+        except BaseException:
+            admission.release()
+            breaker.record_cancelled()
+            raise
+        else:
+            elapsed = time.perf_counter() - started
+            UPSTREAM_SECONDS.observe(elapsed, operation=operation, status=response.status_code)
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success(elapsed)
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= retries:
+                # A streamed response keeps its admission slot until the body is closed by stream()
+                if not stream:
+                    admission.release()
+                return response
+            admission.release()
+            await response.aclose()
+            logger.warning("Upstream %s request returned %s, retrying", operation, response.status_code)
+        await asyncio.sleep(random.uniform(0, PRALNIE_RETRY_BACKOFF * 2 ** attempt))
+
+
+async def request(operation: str, method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Sends a request through the shared client using the timeouts of the given operation,
+    once the admission controller lets it through. Idempotent GET requests are retried
+    with jittered exponential backoff on transport errors and gateway errors.
+    Raises CircuitOpen without sending anything while the operation's circuit is open.
+    """
+    return await _send(operation, method, url, stream=False, **kwargs)
+
+
+@asynccontextmanager
+async def stream(operation: str, method: str, url: str, **kwargs):
+    """
+    Like request(), but the response body is not read upfront: it can be consumed
+    incrementally with response.aiter_bytes() inside the context.
+    """
+    response = await _send(operation, method, url, stream=True, **kwargs)
+    try:
+        yield response
+    finally:
+        try:
+            await response.aclose()
+        finally:
+            admission.release()
@@ -1,22 +1,47 @@
 import logging
-import random
 import time
-from datetime import datetime, timedelta, timezone
-
-import requests
+import urllib.parse
 
 from config import PRALNIE_LOGIN_URL
 from database.db import UserDatabase
+from laundry import client
+from laundry.sessions import session_registry
+from laundry.singleflight import flights
+
+logger = logging.getLogger(__name__)
+
+# Lifetime assumed for session cookies that do not report their own expiry
+DEFAULT_COOKIE_LIFETIME = 25 * 86400
+
+
+class SessionExpired(Exception):
+    """Raised when the laundry service answers as if the user's session was logged out."""
+
+    def __init__(self, chat_id, cookie_data):
+        super().__init__(f"Session expired for chat_id {chat_id}")
+        self.chat_id = chat_id
+        self.cookie_data = cookie_data
+
 
+def is_logged_out(response) -> bool:
+    """Checks whether a response is a 401/403 or a redirect to the login page."""
+    if response.status_code in (401, 403):
+        return True
+    location = response.headers.get("Location")
+    if not response.is_redirect or not location:
+        return False
+    target = urllib.parse.urljoin(str(response.url), location)
+    return urllib.parse.urlsplit(target).path == urllib.parse.urlsplit(PRALNIE_LOGIN_URL).path
 
-def generate_session_cookies(login: str, password: str, chat_id: int):
+
+async def generate_session_cookies(login: str, password: str, chat_id: int):
     """
     Generates and stores session cookies for the laundry service.
     Sends a POST request to authenticate the user, extracts session cookies upon success,
-    and saves them along with their expiration times in the database.
+    and saves them along with their expiration times and the credentials in one database write.
+    Returns None if the credentials are rejected and raises UpstreamError if the service fails.
     """
-    logging.info(f"Generating session cookies for user {login} (chat_id: {chat_id})")
-    session = requests.Session()
+    logger.info("Generating session cookies for user %s (chat_id: %s)", login, chat_id)
     data = {
         "LoginForm[username]": login,
         "LoginForm[password]": password,
@@ -24,70 +49,65 @@ def generate_session_cookies(login: str, password: str, chat_id: int):
         "yt0": "Zaloguj"
     }
 
-    response = session.post(PRALNIE_LOGIN_URL, data=data, allow_redirects=False)
+    response = await client.request("login", "POST", PRALNIE_LOGIN_URL, data=data)
 
+    if response.status_code >= 500:
+        # The service is failing, the credentials may well be right
+        raise client.UpstreamError(f"Login failed with status {response.status_code}")
     if response.status_code != 302:
-        logging.error(f"Failed to obtain session cookies for user {login}. Status code: {response.status_code}")
+        logger.error("Failed to obtain session cookies for user %s. Status code: %s", login, response.status_code)
         return None
 
-    cookies = session.cookies
+    cookies = response.cookies.jar
     cookie_data = "; ".join(f"{c.name}={c.value}" for c in cookies)
     db = UserDatabase()
 
-    try:
-        cookie_expirations = {
-            c.name: datetime.utcfromtimestamp(c.expires).strftime("%Y-%m-%d %H:%M:%S UTC")
-            for c in cookies if c.expires
-        }
-        expiration_time = (
-            next(iter(cookie_expirations.values()),
-                 (datetime.now() + timedelta(days=25)).strftime("%Y-%m-%d %H:%M:%S UTC"))
-        )
-        db.set_cookie_expirations(chat_id, expiration_time)
-        logging.info(f"Stored cookie expiration times: {cookie_expirations}")
-    except Exception as e:
-        fallback_expiration = (datetime.now() + timedelta(days=25)).strftime("%Y-%m-%d %H:%M:%S UTC")
-        db.set_cookie_expirations(chat_id, fallback_expiration)
-        logging.error(f"Error processing cookies: {e}. Using default expiration: {fallback_expiration}")
-
-    logging.info(f"Session cookies successfully generated for user {login}.")
-    db.set_cookies(chat_id, cookie_data)
+    cookie_expirations = {c.name: int(c.expires) for c in cookies if c.expires}
+    expires_at = next(iter(cookie_expirations.values()), int(time.time()) + DEFAULT_COOKIE_LIFETIME)
+    logger.info("Cookie expiration times: %s", cookie_expirations)
+
+    await db.aio.upsert_user(
+        chat_id,
+        username=login,
+        password=password,
+        cookies=cookie_data,
+        cookie_expires_at=expires_at
+    )
+    logger.info("Session cookies successfully generated for user %s.", login)
 
     return cookie_data
 
 
-def refresh_cookies(days_before=5):
+async def relogin(chat_id: int, expired_cookie_data: str):
     """
-    Checks all users, and if the cookie expiration time is <= days_before,
-    calls the function to generate new cookies.
-    Adds a delay of about 10 minutes +/- a few seconds between each refresh.
+    Logs the user in again with the stored credentials after their session expired.
+    Concurrent callers share one login, and callers whose session was already renewed
+    by someone else get the new cookies without logging in again.
     """
-    logging.info("Starting cookie refresh")
+    # The cookies may have been renewed by another process, so the retry reads them from the database
+    session_registry.invalidate(chat_id)
     db = UserDatabase()
-    users = db.get_users_data()
-    now = datetime.now(timezone.utc)
-    for user in users:
-        cookie_expiration = user['cookie_expirations']
-
-        if cookie_expiration.tzinfo is None:
-            cookie_expiration = cookie_expiration.replace(tzinfo=timezone.utc)
-
-        time_to_expiration = cookie_expiration - now
-        if time_to_expiration <= timedelta(days=days_before):
-            logging.info(f"Refreshing cookies for chat_id {user['chat_id']} (expires in {time_to_expiration})")
-            if not generate_session_cookies(user['username'], user['password'], user['chat_id']):
-                logging.error(f"Error refreshing cookies for chat_id {user['chat_id']}.")
-            delay = 10 * 60 + random.randint(-60, 60)
-            logging.info(f"Waiting {delay} seconds before the next refresh")
-            time.sleep(delay)
-    logging.info("Cookie refresh completed")
-
-
-def refresh_cookies_daemon(days_before=5):
+    user = await db.aio.get_user(chat_id)
+    if user is None or not user['username'] or not user['password']:
+        return None
+    if user['cookies'] and user['cookies'] != expired_cookie_data:
+        return user['cookies']
+    logger.info("Session expired for chat_id %s, logging in again", chat_id)
+    return await flights.do(
+        ("login", chat_id),
+        lambda: generate_session_cookies(user['username'], user['password'], chat_id)
+    )
+
+
+async def with_relogin(chat_id: int, call):
     """
-    Runs refresh_cookies once a day indefinitely.
+    Runs call() and, if it raises SessionExpired, logs in again once and retries it.
+    Returns None if the user could not be logged in again.
     """
-    while True:
-        refresh_cookies(days_before)
-        logging.info("Daily check complete. Waiting 24 hours until the next check.")
-        time.sleep(86400)
+    try:
+        return await call()
+    except SessionExpired as e:
+        if not await relogin(chat_id, e.cookie_data):
+            logger.error("Could not log in again for chat_id %s", chat_id)
+            return None
+    return await call()
@@ -0,0 +1,96 @@
+import codecs
+import json
+import re
+from decimal import Decimal
+
+_WHITESPACE = " \t\n\r"
+# The usual separator after an element, consumed right away
+_SEPARATOR = re.compile(r"[ \t\n\r]*,[ \t\n\r]*")
+
+
+async def iter_json_array(chunks, parse_float=Decimal):
+    """
+    Yields the elements of a top-level JSON array one at a time from an async iterator of byte chunks,
+    so only the element being parsed and one chunk are held in memory.
+    Floats are parsed with parse_float (Decimal by default) to keep amounts exact.
+    Raises ValueError if the document is not a well-formed JSON array.
+    """
+    decoder = json.JSONDecoder(parse_float=parse_float)
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = chunks.__aiter__()
+    buffer = ""
+    pos = 0
+    finished = False
+    started = False
+    # After an element only "," or "]" may follow, after a "," only another element
+    after_value = False
+    after_comma = False
+
+    async def read_more():
+        nonlocal buffer, pos, finished
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            finished = True
+            buffer = buffer[pos:] + text_decoder.decode(b"", final=True)
+        else:
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+        if pos == len(buffer):
+            if finished:
+                raise ValueError("Unexpected end of JSON array")
+            await read_more()
+            continue
+
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if after_value:
+            if buffer[pos] == "]":
+                return
+            if buffer[pos] != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, got {buffer[pos]!r}")
+            after_value = False
+            after_comma = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            if after_comma:
+                raise ValueError("Unexpected ']' after ',' in JSON array")
+            return
+        if buffer[pos] == ",":
+            raise ValueError("Expected an element in JSON array, got ','")
+
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if finished:
+                raise
+            await read_more()
+            continue
+        # A number or literal at the end of the buffer may continue in the next chunk
+        # (e.g. "12.50" split as "1" + "2.50", "12" + ".50" or "12." + "50")
+        if (end == len(buffer) or buffer[end] in ".eE") and not finished and not isinstance(value, (dict, list, str)):
+            await read_more()
+            continue
+        # The separator is consumed right away, ", " as written by json.dumps being the common case
+        if buffer.startswith(", ", end):
+            pos = end + 2
+            after_comma = True
+        else:
+            separator = _SEPARATOR.match(buffer, end)
+            if separator is not None:
+                pos = separator.end()
+                after_comma = True
+            else:
+                pos = end
+                after_value = True
+                after_comma = False
+        yield value
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from config import LEADER_LEASE_TTL
+from database.db import UserDatabase
+from metrics.registry import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """
+    Runs a daemon in only one of the processes sharing the database.
+    The process holding the named lease runs it and renews the lease every ttl / 3 seconds;
+    if it stops renewing, another process takes the lease over once it expires.
+    A daemon that ends while the lease is held is logged and started again at the next renewal.
+    A renewal that fails with an error keeps the daemon running until the lease it holds expires.
+    """
+
+    def __init__(self, name: str, ttl: float = LEADER_LEASE_TTL, holder: str = None):
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self._task = None
+        # Monotonic time at which the lease last renewed by this process expires
+        self._lease_until = 0.0
+
+    @property
+    def is_leader(self) -> bool:
+        return self._task is not None
+
+    async def _step_down(self):
+        """Cancels the daemon and waits for it to finish cleaning up."""
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _check_daemon(self):
+        """Forgets a daemon task that has ended, so that the next renewal starts it again."""
+        if self._task is None or not self._task.done():
+            return
+        task, self._task = self._task, None
+        if task.cancelled():
+            logger.warning("The %s daemon was cancelled, restarting it", self.name)
+        elif task.exception() is not None:
+            logger.error("The %s daemon failed, restarting it", self.name, exc_info=task.exception())
+        else:
+            logger.warning("The %s daemon returned, restarting it", self.name)
+
+    async def run(self, daemon):
+        """Competes for the lease forever, running daemon() while it is held."""
+        db = UserDatabase()
+        try:
+            while True:
+                self._check_daemon()
+                started = time.monotonic()
+                try:
+                    acquired = await db.aio.try_acquire_lease(self.name, self.holder, self.ttl)
+                except Exception as e:
+                    logger.error("Error renewing the %s lease: %s", self.name, e)
+                    # Nobody else can take the lease before it expires, keep leading if it outlasts the next try
+                    acquired = self._task is not None and time.monotonic() + self.ttl / 3 < self._lease_until
+                else:
+                    if acquired:
+                        self._lease_until = started + self.ttl
+                if acquired and self._task is None:
+                    logger.info("%s acquired the %s lease", self.holder, self.name)
+                    self._task = asyncio.create_task(daemon())
+                elif not acquired and self._task is not None:
+                    logger.warning("%s lost the %s lease", self.holder, self.name)
+                    await self._step_down()
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if self._task is not None:
+                await self._step_down()
+                await db.aio.release_lease(self.name, self.holder)
+
+
+refresh_leader = LeaderElection("refresh_scheduler")
+outbox_leader = LeaderElection("outbox")
+
+REGISTRY.gauge(
+    "leader", "Whether this process holds the lease of a singleton daemon", ["lease"],
+    callback=lambda: {(election.name,): int(election.is_leader) for election in (refresh_leader, outbox_leader)}
+)
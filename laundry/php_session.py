@@ -0,0 +1,152 @@
+"""
+Decoder (and a matching encoder) for PHP's serialize() format, as found in the pralnie.org identity cookie.
+"""
+import functools
+import math
+import re
+import urllib.parse
+
+# Identity cookies decoded and kept in memory
+IDENTITY_CACHE_SIZE = 4096
+
+# Some cookies carry the payload length between the hash and the payload: "<hash>:<length>:a:4:{...}"
+_LENGTH_PREFIX = re.compile(r"\d+:(?=[Nbidsa][:;])")
+
+# Type letters and delimiters as byte values
+_NULL, _BOOL, _INT, _FLOAT, _STRING, _ARRAY = b"Nbidsa"
+_COLON, _SEMICOLON, _QUOTE = b':;"'
+_SPECIAL_FLOATS = {b"INF": math.inf, b"-INF": -math.inf, b"NAN": math.nan}
+
+
+class PHPSerializeError(ValueError):
+    """Raised when a string is not valid PHP serialize() output."""
+
+
+def _read_until(data: bytes, pos: int, terminator: int):
+    end = data.find(terminator, pos)
+    if end < 0:
+        raise PHPSerializeError(f"Unterminated value at offset {pos}")
+    return data[pos:end], end + 1
+
+
+def _read_int(data: bytes, pos: int, terminator: int):
+    raw, end = _read_until(data, pos, terminator)
+    # int() would also accept whitespace, "+" and underscores, PHP does not
+    digits = raw[1:] if raw[:1] == b"-" else raw
+    if not digits.isdigit():
+        raise PHPSerializeError(f"Invalid integer {raw!r} at offset {pos}")
+    return int(raw), end
+
+
+def _expect(data: bytes, pos: int, delimiter: int) -> int:
+    if pos >= len(data) or data[pos] != delimiter:
+        raise PHPSerializeError(f"Expected {chr(delimiter)!r} at offset {pos}")
+    return pos + 1
+
+
+def _decode(data: bytes, pos: int, depth: int):
+    if pos >= len(data):
+        raise PHPSerializeError("Unexpected end of data")
+    kind = data[pos]
+    if kind == _NULL:
+        return None, _expect(data, pos + 1, _SEMICOLON)
+    pos = _expect(data, pos + 1, _COLON)
+    if kind == _INT:
+        return _read_int(data, pos, _SEMICOLON)
+    if kind == _STRING:
+        length, pos = _read_int(data, pos, _COLON)
+        pos = _expect(data, pos, _QUOTE)
+        end = pos + length
+        if length < 0 or end + 2 > len(data):
+            raise PHPSerializeError(f"String length {length} out of range at offset {pos}")
+        _expect(data, _expect(data, end, _QUOTE), _SEMICOLON)
+        try:
+            return data[pos:end].decode("utf-8"), end + 2
+        except UnicodeDecodeError:
+            raise PHPSerializeError(f"String at offset {pos} is not valid UTF-8") from None
+    if kind == _ARRAY:
+        if depth <= 0:
+            raise PHPSerializeError("Arrays nested too deeply")
+        count, pos = _read_int(data, pos, _COLON)
+        if count < 0:
+            raise PHPSerializeError(f"Invalid array size {count} at offset {pos}")
+        pos = _expect(data, pos, ord("{"))
+        result = {}
+        for _ in range(count):
+            key, pos = _decode(data, pos, depth - 1)
+            if type(key) not in (int, str):
+                raise PHPSerializeError(f"Invalid array key {key!r} before offset {pos}")
+            result[key], pos = _decode(data, pos, depth - 1)
+        return result, _expect(data, pos, ord("}"))
+    if kind == _BOOL:
+        raw, end = _read_until(data, pos, _SEMICOLON)
+        if raw not in (b"0", b"1"):
+            raise PHPSerializeError(f"Invalid boolean {raw!r} at offset {pos}")
+        return raw == b"1", end
+    if kind == _FLOAT:
+        raw, end = _read_until(data, pos, _SEMICOLON)
+        if raw in _SPECIAL_FLOATS:
+            return _SPECIAL_FLOATS[raw], end
+        try:
+            return float(raw.decode("ascii")), end
+        except (UnicodeDecodeError, ValueError):
+            raise PHPSerializeError(f"Invalid float {raw!r} at offset {pos}") from None
+    raise PHPSerializeError(f"Unsupported type {chr(kind)!r} at offset {pos - 2}")
+
+
+def unserialize(data, max_depth: int = 32):
+    """
+    Decodes one value produced by PHP's serialize(): null, booleans, integers, floats, strings
+    and arrays (as dicts keyed by int or str, in order), nested up to max_depth levels.
+    String lengths are taken from their byte length prefixes, so the input is read in a single
+    pass without searching for quotes. Raises PHPSerializeError on malformed or trailing data.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    value, pos = _decode(data, 0, max_depth)
+    if pos != len(data):
+        raise PHPSerializeError(f"Unexpected data after offset {pos}")
+    return value
+
+
+def serialize(value) -> str:
+    """Encodes None, bools, ints, floats, strings, lists and dicts the way PHP's serialize() does."""
+    if value is None:
+        return "N;"
+    if isinstance(value, bool):
+        return f"b:{int(value)};"
+    if isinstance(value, int):
+        return f"i:{value};"
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "d:NAN;"
+        if math.isinf(value):
+            return "d:INF;" if value > 0 else "d:-INF;"
+        return f"d:{value!r};"
+    if isinstance(value, str):
+        return f's:{len(value.encode("utf-8"))}:"{value}";'
+    if isinstance(value, (list, tuple)):
+        value = dict(enumerate(value))
+    if isinstance(value, dict):
+        items = "".join(serialize(key) + serialize(item) for key, item in value.items())
+        return f"a:{len(value)}:{{{items}}}"
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+@functools.lru_cache(maxsize=IDENTITY_CACHE_SIZE)
+def decode_identity_cookie(value: str):
+    """
+    Decodes an identity cookie value: URL-encoded, a hash followed by the serialized identity
+    array (id, name, duration, states), optionally separated by ":<length>:". Results are cached
+    by cookie value and shared, so callers must not modify them.
+    Raises PHPSerializeError if the cookie is malformed.
+    """
+    decoded = urllib.parse.unquote(value)
+    colon = decoded.find(":")
+    if colon < 1:
+        raise PHPSerializeError("Identity cookie has no serialized payload")
+    prefix = _LENGTH_PREFIX.match(decoded, colon + 1)
+    if prefix is not None:
+        return unserialize(decoded[prefix.end():])
+    # The hash is hex and has no ":", so the first one follows the type letter of the payload
+    return unserialize(decoded[colon - 1:])
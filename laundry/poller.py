@@ -0,0 +1,179 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from config import (
+    BALANCE_POLL_MIN_INTERVAL,
+    BALANCE_POLL_MAX_INTERVAL,
+    BALANCE_POLL_IDLE_FACTOR,
+    BALANCE_POLL_FORGET_AFTER,
+    BALANCE_POLL_RATE_PER_MINUTE,
+    BALANCE_POLL_MAX_CONCURRENT,
+)
+from laundry.account_balance import refresh_balance
+from laundry.admission import background_priority
+from laundry.balance_cache import balance_cache
+from laundry.circuit import CircuitOpen
+from laundry.ratelimit import TokenBucket
+from metrics.registry import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class BalancePoller:
+    """
+    Keeps the cached balances of active users warm by polling the laundry service in the background.
+    The poll interval grows with the time since the user's last command, all polls share one
+    upstream request budget, and notify(chat_id, old, new) is awaited when a balance changes.
+    Changes are detected against the balance seen by the previous poll, so a balance dropped
+    from the cache, e.g. by a top-up, is still compared with its last value.
+    """
+
+    def __init__(self, min_interval=BALANCE_POLL_MIN_INTERVAL, max_interval=BALANCE_POLL_MAX_INTERVAL,
+                 idle_factor=BALANCE_POLL_IDLE_FACTOR, forget_after=BALANCE_POLL_FORGET_AFTER,
+                 rate_per_minute=BALANCE_POLL_RATE_PER_MINUTE, max_concurrent=BALANCE_POLL_MAX_CONCURRENT,
+                 notify=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_factor = idle_factor
+        self.forget_after = forget_after
+        self.max_concurrent = max_concurrent
+        self.notify = notify
+        self._bucket = TokenBucket(rate_per_minute / 60, max(1.0, rate_per_minute / 60))
+        self._heap = []
+        self._due = {}
+        self._last_active = {}
+        # chat_id -> balance seen by the last poll
+        self._last_balance = {}
+        self._tasks = set()
+        self._wakeup = None
+        self._semaphore = None
+        self.polls = 0
+        self.changes = 0
+
+    @property
+    def running(self) -> bool:
+        return self._wakeup is not None
+
+    def interval(self, chat_id: int) -> float:
+        """Returns the poll interval for chat_id based on how long ago the user was active."""
+        idle = time.time() - self._last_active.get(chat_id, 0)
+        return min(self.max_interval, max(self.min_interval, idle * self.idle_factor))
+
+    def _schedule(self, chat_id: int, due_at: float):
+        self._due[chat_id] = due_at
+        heapq.heappush(self._heap, (due_at, chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def touch(self, chat_id: int):
+        """Marks chat_id as active, so its balance is polled at the shortest interval."""
+        if not self.running:
+            return
+        now = time.time()
+        self._last_active[chat_id] = now
+        due_at = now + self.min_interval
+        if self._due.get(chat_id, float("inf")) > due_at:
+            self._schedule(chat_id, due_at)
+
+    def forget(self, chat_id: int):
+        """Stops polling chat_id."""
+        self._due.pop(chat_id, None)
+        self._last_active.pop(chat_id, None)
+        self._last_balance.pop(chat_id, None)
+
+    def snapshot(self) -> list:
+        """Returns [chat_id, last_active, due_at] for every polled user."""
+        return [[chat_id, last_active, self._due.get(chat_id)] for chat_id, last_active in self._last_active.items()]
+
+    def restore(self, entries):
+        """Resumes polling the users of a snapshot() that have not been idle for too long."""
+        now = time.time()
+        for chat_id, last_active, due_at in entries:
+            if now - last_active > self.forget_after or chat_id in self._last_active:
+                continue
+            self._last_active[chat_id] = last_active
+            self._schedule(chat_id, due_at if due_at is not None else now)
+
+    def _pop_due(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            due_at, chat_id = heapq.heappop(self._heap)
+            if self._due.get(chat_id) == due_at:
+                del self._due[chat_id]
+                return chat_id
+        return None
+
+    async def _poll(self, chat_id: int):
+        try:
+            old = self._last_balance.get(chat_id)
+            if old is None:
+                entry = balance_cache.peek(chat_id)
+                old = entry.value if entry is not None else None
+            new = await refresh_balance(chat_id)
+            self.polls += 1
+            if new is None:
+                self.forget(chat_id)
+                return
+            if chat_id in self._last_active:
+                self._last_balance[chat_id] = new
+            if old is not None and new != old:
+                self.changes += 1
+                logger.info("Balance of chat_id %s changed from %s to %s", chat_id, old, new)
+                if self.notify is not None:
+                    await self.notify(chat_id, old, new)
+        except CircuitOpen as e:
+            logger.debug("Skipping the balance poll of chat_id %s: %s", chat_id, e)
+        except Exception as e:
+            logger.error("Error polling the balance of chat_id %s: %s", chat_id, e)
+        finally:
+            self._semaphore.release()
+        if chat_id in self._last_active:
+            if time.time() - self._last_active[chat_id] > self.forget_after:
+                self.forget(chat_id)
+            elif chat_id not in self._due:
+                self._schedule(chat_id, time.time() + self.interval(chat_id))
+
+    async def run(self):
+        """Runs the poller forever on the current event loop."""
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        # Polls started from here wait behind user-facing requests
+        with background_priority():
+            await self._loop()
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            chat_id = self._pop_due(time.time())
+            if chat_id is not None:
+                await self._semaphore.acquire()
+                await self._bucket.acquire()
+                task = asyncio.create_task(self._poll(chat_id))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+balance_poller = BalancePoller()
+
+REGISTRY.gauge(
+    "balance_poller", "Background balance poller: tracked users, polls done and balance changes seen", ["stat"],
+    callback=lambda: {
+        ("tracked",): len(balance_poller._last_active),
+        ("polls",): balance_poller.polls,
+        ("changes",): balance_poller.changes,
+    }
+)
+
+
+async def balance_poll_daemon():
+    """
+    Runs the background balance poller on the bot's event loop.
+    """
+    await balance_poller.run()
@@ -0,0 +1,37 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: holds up to capacity tokens and refills at rate tokens per second.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Takes tokens if they are available right now."""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens: float = 1) -> float:
+        """Returns how many seconds until the given number of tokens is available."""
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens: float = 1):
+        """Waits until tokens are available and takes them."""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
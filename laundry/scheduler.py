@@ -0,0 +1,256 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from config import (
+    REFRESH_DAYS_BEFORE,
+    REFRESH_RATE_PER_HOUR,
+    REFRESH_BURST,
+    REFRESH_MAX_CONCURRENT,
+    REFRESH_RETRY_DELAY,
+    REFRESH_LOAD_HORIZON,
+    REFRESH_LOAD_LIMIT,
+)
+from database.db import UserDatabase
+from laundry.admission import background_priority
+from laundry.circuit import CircuitOpen, get_breaker
+from laundry.cookies import generate_session_cookies
+from laundry.ratelimit import TokenBucket
+from metrics.registry import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Seconds before a failed load() from the database is tried again
+LOAD_RETRY_DELAY = 60
+
+
+class RefreshScheduler:
+    """
+    Refreshes session cookies shortly before they expire.
+    Keeps a min-heap of refresh deadlines and sleeps until the earliest one is due.
+    Refreshes are paced by a token bucket and at most max_concurrent of them run at once.
+    Only users due within load_horizon are held in memory, the rest stay in the database.
+    on_failure(chat_id), if set, is awaited the first time the laundry service rejects a user's stored credentials.
+    Refreshes pause while the login circuit is open.
+    """
+
+    def __init__(self, days_before=REFRESH_DAYS_BEFORE, rate_per_hour=REFRESH_RATE_PER_HOUR,
+                 burst=REFRESH_BURST, max_concurrent=REFRESH_MAX_CONCURRENT, retry_delay=REFRESH_RETRY_DELAY,
+                 load_horizon=REFRESH_LOAD_HORIZON, load_limit=REFRESH_LOAD_LIMIT, on_failure=None):
+        self.lead_time = days_before * 86400
+        self.retry_delay = retry_delay
+        self.load_horizon = load_horizon
+        self.load_limit = load_limit
+        self.max_concurrent = max_concurrent
+        self.on_failure = on_failure
+        self._bucket = TokenBucket(rate_per_hour / 3600, burst)
+        self._heap = []
+        # chat_id -> (refresh_at, expires_at) of the entry currently valid for that user
+        self._entries = {}
+        self._running = set()
+        # Users already told that their session could not be refreshed
+        self._failed = set()
+        self._tasks = set()
+        self._wakeup = None
+        self._semaphore = None
+        # Time of the next load() from the database
+        self._next_load = 0
+
+    def schedule(self, chat_id: int, expires_at: float, refresh_at: float = None):
+        """
+        Schedules a refresh for chat_id, replacing any earlier entry for that user.
+        Refreshes beyond the load horizon are left to a later load() from the database.
+        """
+        if refresh_at is None:
+            refresh_at = expires_at - self.lead_time
+        if refresh_at > time.time() + self.load_horizon:
+            # A running refresh reschedules the user itself when it ends
+            if chat_id not in self._running:
+                self.forget(chat_id)
+            return
+        self._entries[chat_id] = (refresh_at, expires_at)
+        heapq.heappush(self._heap, (refresh_at, chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def forget(self, chat_id: int):
+        """Stops refreshing cookies for chat_id."""
+        self._entries.pop(chat_id, None)
+
+    async def track(self, chat_id: int):
+        """Schedules chat_id using the cookie expiration stored in the database, e.g. after a login."""
+        expiration = await UserDatabase().aio.get_cookie_expirations(chat_id)
+        if expiration is None:
+            self.forget(chat_id)
+            return
+        self.schedule(chat_id, expiration)
+
+    async def load(self) -> float:
+        """
+        Schedules the users whose refresh is due within the load horizon and returns
+        the time at which the next load is needed.
+        """
+        now = time.time()
+        users = await UserDatabase().aio.get_users_due_before(now + self.lead_time + self.load_horizon,
+                                                              self.load_limit)
+        for user in users:
+            # Users already scheduled for this expiration keep their entry (and any retry delay)
+            if self._entries.get(user['chat_id'], (None, None))[1] != user['cookie_expires_at']:
+                self.schedule(user['chat_id'], user['cookie_expires_at'])
+        logger.info("Refresh scheduler loaded %s users due within the next %.0f s", len(users), self.load_horizon)
+        if len(users) == self.load_limit:
+            return users[-1]['cookie_expires_at'] - self.lead_time
+        return now + self.load_horizon / 2
+
+    def time_left(self) -> dict:
+        """Returns the number of seconds left before each tracked user's cookies expire."""
+        now = time.time()
+        return {chat_id: expires_at - now for chat_id, (_, expires_at) in self._entries.items()}
+
+    def report(self) -> dict:
+        """Summarizes how far behind the scheduler is."""
+        now = time.time()
+        overdue = [now - refresh_at for refresh_at, _ in self._entries.values() if refresh_at <= now]
+        time_left = self.time_left().values()
+        return {
+            "tracked": len(self._entries),
+            "due": len(overdue),
+            "running": len(self._running),
+            "max_overdue": max(overdue, default=0.0),
+            "min_time_left": min(time_left, default=None),
+            "expired": sum(1 for left in time_left if left <= 0),
+        }
+
+    def snapshot(self) -> dict:
+        """Returns the in-memory schedule so that a restarted process can resume it without a reload."""
+        return {
+            "next_load": self._next_load,
+            "entries": [[chat_id, refresh_at, expires_at] for chat_id, (refresh_at, expires_at) in self._entries.items()],
+        }
+
+    def restore(self, state: dict):
+        """Resumes a schedule produced by snapshot(); the next load() still reconciles it with the database."""
+        for chat_id, refresh_at, expires_at in state["entries"]:
+            if chat_id not in self._entries:
+                self.schedule(chat_id, expires_at, refresh_at)
+        self._next_load = max(self._next_load, min(state["next_load"], time.time() + self.load_horizon / 2))
+
+    def _pop_due(self, now):
+        """Returns (chat_id, expires_at) of the next due refresh, or None."""
+        while self._heap and self._heap[0][0] <= now:
+            refresh_at, chat_id = heapq.heappop(self._heap)
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry[0] == refresh_at and chat_id not in self._running:
+                return chat_id, entry[1]
+        return None
+
+    def _requeue(self, chat_id: int):
+        """Puts back the current entry of a chat whose refresh was popped but not carried out."""
+        entry = self._entries.get(chat_id)
+        if entry is not None:
+            heapq.heappush(self._heap, (entry[0], chat_id))
+
+    async def _refresh(self, chat_id: int, expires_at: float):
+        # The entry may be replaced or forgotten while the refresh waits, so expires_at comes from _pop_due()
+        retry_delay = self.retry_delay
+        try:
+            user = await UserDatabase().aio.get_user(chat_id)
+            if user is None or not user['username'] or not user['password']:
+                self.forget(chat_id)
+                return
+            logger.info("Refreshing cookies for chat_id %s (expires in %.0f s)", chat_id, expires_at - time.time())
+            if await generate_session_cookies(user['username'], user['password'], chat_id):
+                self._failed.discard(chat_id)
+                # Done, so track() may replace or drop the entry the refresh was started from
+                self._running.discard(chat_id)
+                await self.track(chat_id)
+                return
+            logger.error("Error refreshing cookies for chat_id %s.", chat_id)
+            if self.on_failure is not None and chat_id not in self._failed:
+                self._failed.add(chat_id)
+                await self.on_failure(chat_id)
+        except CircuitOpen as e:
+            # Not the user's fault: try again once the laundry service may be back
+            logger.info("Postponing the cookie refresh for chat_id %s: %s", chat_id, e)
+            retry_delay = e.retry_in
+        except asyncio.CancelledError:
+            # The scheduler stopped, the next run() picks the refresh up again
+            self._requeue(chat_id)
+            raise
+        except Exception as e:
+            logger.error("Error refreshing cookies for chat_id %s: %s", chat_id, e)
+        finally:
+            self._running.discard(chat_id)
+            self._semaphore.release()
+        self.schedule(chat_id, expires_at, refresh_at=time.time() + retry_delay)
+
+    async def run(self):
+        """Runs the scheduler forever on the current event loop."""
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        # Refreshes started from here wait behind user-facing requests
+        with background_priority():
+            try:
+                await self._loop()
+            finally:
+                # Stopped, e.g. on losing the leader lease: no refresh may outlive the scheduler
+                tasks = list(self._tasks)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _loop(self):
+        login = get_breaker("login")
+        while True:
+            self._wakeup.clear()
+            if time.time() >= self._next_load:
+                try:
+                    self._next_load = await self.load()
+                except Exception as e:
+                    logger.error("Error loading users due for a refresh: %s", e)
+                    self._next_load = time.time() + LOAD_RETRY_DELAY
+            if not login.available:
+                # Logging in against a laundry service that is down would only fail, wait for the circuit instead
+                await asyncio.sleep(max(login.retry_in, 1.0))
+                continue
+            due = self._pop_due(time.time())
+            if due is not None:
+                chat_id, expires_at = due
+                try:
+                    await self._semaphore.acquire()
+                except asyncio.CancelledError:
+                    self._requeue(chat_id)
+                    raise
+                try:
+                    await self._bucket.acquire()
+                except asyncio.CancelledError:
+                    self._semaphore.release()
+                    self._requeue(chat_id)
+                    raise
+                self._running.add(chat_id)
+                task = asyncio.create_task(self._refresh(chat_id, expires_at))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+            next_load = min(self._heap[0][0], self._next_load) if self._heap else self._next_load
+            timeout = next_load - time.time()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+refresh_scheduler = RefreshScheduler()
+
+REGISTRY.gauge(
+    "refresh_scheduler", "Cookie refresh backlog: tracked, due and running refreshes, lag and time left", ["stat"],
+    callback=lambda: {(name,): value for name, value in refresh_scheduler.report().items()}
+)
+
+
+async def refresh_cookies_daemon():
+    """
+    Runs the cookie refresh scheduler on the bot's event loop.
+    """
+    await refresh_scheduler.run()
@@ -0,0 +1,151 @@
+import threading
+from collections import OrderedDict
+
+from config import SESSION_REGISTRY_MAX_SIZE
+from database.db import UserDatabase
+from laundry.php_session import PHPSerializeError, decode_identity_cookie
+from metrics.registry import REGISTRY
+
+# Returned by SessionRegistry.get() for chats it knows nothing about, as opposed to None for logged out chats
+MISSING = object()
+
+
+def parse_cookie_header(cookie_data: str) -> dict:
+    """Splits a "name=value; name2=value2" cookie string into a dict."""
+    cookies = {}
+    for cookie in cookie_data.split(";"):
+        cookie = cookie.strip()
+        if "=" in cookie:
+            key, value = cookie.split("=", 1)
+            cookies[key] = value
+    return cookies
+
+
+def extract_user_id(cookies: dict):
+    """
+    Recovers the pralnie.org user id from the identity cookie, the one that is not PHPSESSID:
+    an URL-encoded hash prefix followed by a PHP serialized array whose first element is the id.
+    Returns None if there is no such cookie or it cannot be parsed.
+    """
+    user_cookie_key = next((key for key in cookies if key != "PHPSESSID"), None)
+    if user_cookie_key is None:
+        return None
+    try:
+        identity = decode_identity_cookie(cookies[user_cookie_key])
+    except PHPSerializeError:
+        return None
+    return identity.get(0) if isinstance(identity, dict) else None
+
+
+class Session:
+    """A user's session at the laundry service: the stored cookie string, its parsed form, the user id and expiry."""
+
+    __slots__ = ("cookie_data", "cookies", "user_id", "expires_at")
+
+    def __init__(self, cookie_data: str, expires_at=None):
+        self.cookie_data = cookie_data
+        self.cookies = parse_cookie_header(cookie_data)
+        self.user_id = extract_user_id(self.cookies)
+        self.expires_at = expires_at
+
+
+class SessionRegistry:
+    """
+    Bounded LRU map of chat_id to Session (or None for chats known to be logged out).
+    Kept current by a UserDatabase write listener, so it can answer without querying the database.
+    """
+
+    def __init__(self, max_size=SESSION_REGISTRY_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._listening = False
+        # Incremented on every write seen, so that a load racing with a write does not cache stale data
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def listen(self, db: UserDatabase):
+        """Subscribes to the database writes, once."""
+        with self._lock:
+            if self._listening:
+                return
+            self._listening = True
+        db.add_write_listener(self._on_write)
+
+    def _on_write(self, chat_id, fields):
+        if "cookies" not in fields and "cookie_expires_at" not in fields:
+            return
+        with self._lock:
+            self._writes += 1
+            if chat_id not in self._entries:
+                return
+            if "cookies" in fields and "cookie_expires_at" in fields:
+                cookie_data = fields["cookies"]
+                self._entries[chat_id] = Session(cookie_data, fields["cookie_expires_at"]) if cookie_data else None
+            else:
+                del self._entries[chat_id]
+
+    @property
+    def writes(self) -> int:
+        return self._writes
+
+    def get(self, chat_id):
+        """Returns the Session of chat_id, None if it is logged out, or MISSING if it is not known."""
+        with self._lock:
+            if chat_id not in self._entries:
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return self._entries[chat_id]
+
+    def put(self, chat_id, session, writes_seen: int = None):
+        """
+        Stores the session of chat_id, unless a write happened after writes_seen was read
+        (the session may have been loaded before that write).
+        """
+        with self._lock:
+            if writes_seen is not None and writes_seen != self._writes:
+                return
+            self._entries[chat_id] = session
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        """Forgets chat_id, so that its session is read from the database again."""
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+session_registry = SessionRegistry()
+
+REGISTRY.gauge(
+    "session_registry", "Session registry lookups by result and number of known chats", ["stat"],
+    callback=lambda: {
+        ("hits",): session_registry.hits,
+        ("misses",): session_registry.misses,
+        ("size",): len(session_registry),
+    }
+)
+
+
+async def get_session(chat_id: int):
+    """
+    Returns the Session of chat_id, or None if the user has no stored cookies.
+    Served from the registry when possible, otherwise loaded from the database once.
+    """
+    session = session_registry.get(chat_id)
+    if session is not MISSING:
+        return session
+    db = UserDatabase()
+    session_registry.listen(db)
+    writes_seen = session_registry.writes
+    user = await db.aio.get_user(chat_id)
+    session = Session(user['cookies'], user['cookie_expires_at']) if user is not None and user['cookies'] else None
+    session_registry.put(chat_id, session, writes_seen)
+    return session
@@ -0,0 +1,61 @@
+import asyncio
+from collections import Counter
+
+from laundry.admission import admission, current_priority, get_shared_priority, use_shared_priority
+from metrics.registry import REGISTRY
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is in flight, later callers
+    with the same key wait for its result instead of starting their own.
+    Keys are tuples starting with the operation name, e.g. ("balance", chat_id).
+    A call runs at the priority of its most urgent caller, so a user joining a background
+    refresh does not wait behind other background traffic.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.started = Counter()
+        self.coalesced = Counter()
+
+    async def do(self, key: tuple, func):
+        """Runs func() for key unless the same call is already in flight, and returns its result."""
+        flight = self._in_flight.get(key)
+        if flight is None:
+            self.started[key[0]] += 1
+            # A call made inside another coalesced call is raised together with it
+            shared = get_shared_priority()
+
+            async def run():
+                use_shared_priority(shared)
+                return await func()
+
+            task = asyncio.create_task(run())
+            self._in_flight[key] = task, shared
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced[key[0]] += 1
+            task, shared = flight
+            admission.raise_priority(shared, current_priority())
+        # A cancelled caller must not cancel the call other callers are waiting for
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        """Returns the number of started and coalesced calls per operation."""
+        return {
+            operation: {"started": self.started[operation], "coalesced": self.coalesced[operation]}
+            for operation in self.started.keys() | self.coalesced.keys()
+        }
+
+
+flights = SingleFlight()
+
+REGISTRY.gauge(
+    "singleflight_calls", "Upstream calls started and coalesced by the singleflight layer", ["operation", "result"],
+    callback=lambda: {
+        (operation, result): count
+        for operation, counts in flights.stats().items()
+        for result, count in counts.items()
+    }
+)
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from config import SNAPSHOT_FILE, SNAPSHOT_INTERVAL
+from laundry.balance_cache import balance_cache
+from laundry.poller import balance_poller
+from laundry.scheduler import refresh_scheduler
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def collect_snapshot() -> dict:
+    """Captures the in-memory state worth keeping across restarts. Must run on the bot's event loop."""
+    return {
+        "version": SNAPSHOT_VERSION,
+        "saved_at": time.time(),
+        "balance_cache": balance_cache.snapshot(),
+        "refresh_scheduler": refresh_scheduler.snapshot(),
+        "balance_poller": balance_poller.snapshot(),
+    }
+
+
+def write_snapshot(state: dict, path: str = SNAPSHOT_FILE):
+    """Writes the snapshot atomically, so a crash mid-write leaves the previous one intact."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str = SNAPSHOT_FILE):
+    """Returns the snapshot stored at path, or None if there is no usable one."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable snapshot %s: %s", path, e)
+        return None
+    if state.get("version") != SNAPSHOT_VERSION:
+        logger.warning("Ignoring snapshot %s with unsupported version %s", path, state.get("version"))
+        return None
+    return state
+
+
+def apply_snapshot(state: dict):
+    """Restores the caches and schedules from a snapshot. Must run on the bot's event loop."""
+    balance_cache.restore(state["balance_cache"])
+    refresh_scheduler.restore(state["refresh_scheduler"])
+    balance_poller.restore(state["balance_poller"])
+    logger.info(
+        "Restored snapshot from %.0f s ago: %s balances, %s scheduled refreshes, %s polled users",
+        time.time() - state["saved_at"], len(balance_cache), len(state["refresh_scheduler"]["entries"]),
+        len(state["balance_poller"])
+    )
+
+
+async def restore_snapshot(path: str = SNAPSHOT_FILE):
+    """Reads the snapshot off the event loop and restores it."""
+    state = await asyncio.to_thread(read_snapshot, path)
+    if state is not None:
+        apply_snapshot(state)
+
+
+async def save_snapshot(path: str = SNAPSHOT_FILE):
+    """Captures the current state and writes it off the event loop."""
+    started = time.perf_counter()
+    state = collect_snapshot()
+    await asyncio.to_thread(write_snapshot, state, path)
+    logger.debug("Snapshot saved to %s in %.1f ms", path, (time.perf_counter() - started) * 1000)
+
+
+async def snapshot_daemon(path: str = SNAPSHOT_FILE, interval: float = SNAPSHOT_INTERVAL):
+    """
+    Saves a snapshot every interval seconds on the bot's event loop.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await save_snapshot(path)
+        except Exception as e:
+            logger.error("Error saving snapshot to %s: %s", path, e)
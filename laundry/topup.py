@@ -1,24 +1,39 @@
 import logging
 
-import requests
+import httpx
 
 from config import PRALNIE_TOPUP_URL
-from database.db import UserDatabase
+from laundry import client
+from laundry.account_balance import invalidate_balance
+from laundry.cookies import SessionExpired, is_logged_out, with_relogin
+from laundry.sessions import get_session
+from laundry.singleflight import flights
 
+logger = logging.getLogger(__name__)
 
-def topup_account(chat_id: int, topup_value: str = '1'):
+
+async def topup_account(chat_id: int, topup_value: str = '1'):
     """
     Perform a top-up operation by sending a POST request.
+    Concurrent requests for the same chat_id and amount share a single upstream call,
+    and an expired session is renewed transparently.
     """
-    logging.info(f"Starting top-up process for chat_id: {chat_id} with value: {topup_value}")
+    return await flights.do(
+        ("topup", chat_id, topup_value),
+        lambda: with_relogin(chat_id, lambda: _request_topup(chat_id, topup_value))
+    )
+
 
-    db = UserDatabase()
-    cookie_data = db.get_cookies(chat_id)
+async def _request_topup(chat_id: int, topup_value: str):
+    logger.info("Starting top-up process for chat_id: %s with value: %s", chat_id, topup_value)
 
-    if not cookie_data:
-        logging.warning(f"No cookies found for chat_id: {chat_id}. Aborting top-up.")
+    session = await get_session(chat_id)
+
+    if session is None:
+        logger.warning("No cookies found for chat_id: %s. Aborting top-up.", chat_id)
         return None
 
+    cookie_data = session.cookie_data
     headers = {"Cookie": cookie_data}
     data = {
         "top_up_id": topup_value,
@@ -28,29 +43,28 @@ def topup_account(chat_id: int, topup_value: str = '1'):
     }
 
     try:
-        print(data)
-        print(headers)
-        logging.info(f"Sending top-up request for chat_id: {chat_id}")
-        response = requests.post(
-            PRALNIE_TOPUP_URL,
-            headers=headers,
-            data=data,
-            allow_redirects=False
-        )
+        # The form is logged without the Cookie header, which carries the user's session
+        logger.debug("Top-up form for chat_id %s: %s", chat_id, data)
+        logger.info("Sending top-up request for chat_id: %s", chat_id)
+        response = await client.request("topup", "POST", PRALNIE_TOPUP_URL, headers=headers, data=data)
+
+        if is_logged_out(response):
+            raise SessionExpired(chat_id, cookie_data)
 
         if response.status_code >= 400:
-            logging.error(f"Top-up request failed with status {response.status_code} for chat_id: {chat_id}")
-            print(response.headers.get("Location"))
+            logger.error("Top-up request failed with status %s for chat_id: %s", response.status_code, chat_id)
             return None
 
         top_up_link = response.headers.get("Location")
         if top_up_link:
-            logging.info(f"Top-up successful for chat_id: {chat_id}. Redirect link: {top_up_link}")
+            logger.info("Top-up successful for chat_id: %s. Redirect link: %s", chat_id, top_up_link)
+            # The user is about to pay, make the next /stan go to the laundry service
+            await invalidate_balance(chat_id)
         else:
-            logging.warning(f"Top-up request for chat_id: {chat_id} returned no redirect link.")
+            logger.warning("Top-up request for chat_id: %s returned no redirect link.", chat_id)
 
         return top_up_link
 
-    except requests.RequestException as e:
-        logging.error(f"Exception occurred during top-up for chat_id: {chat_id} - {e}")
+    except httpx.HTTPError as e:
+        logger.error("Exception occurred during top-up for chat_id: %s - %s", chat_id, e)
         return None
@@ -0,0 +1,214 @@
+import asyncio
+import functools
+import math
+import threading
+import time
+from bisect import bisect_left
+
+# Latency buckets in seconds, from a cached lookup up to a stuck upstream request
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self.samples()
+        ]
+
+
+class Gauge(Metric):
+    """
+    Gauge whose values are either set directly or collected from a callback at scrape time.
+    The callback returns a number or a dict mapping label value tuples to numbers.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+        self._callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self._callback is None:
+            with self._lock:
+                return list(self._values.items())
+        values = self._callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(key, value) for key, value in values.items() if value is not None]
+
+    def render(self):
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self.samples()
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            return [(key, list(state)) for key, state in self._values.items()]
+
+    def quantile(self, state, q):
+        """Estimates a quantile as the upper bound of the bucket it falls into."""
+        count = sum(state[:-1])
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), state[:-1]):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def render(self):
+        lines = self.header()
+        for key, state in self.samples():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), state[:-1]):
+                cumulative += bucket_count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        return self._register(Gauge(name, help_text, labelnames, callback))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Renders a short human readable overview of all metrics."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            for key, value in metric.samples():
+                name = f"{metric.name}{_format_labels(metric.labelnames, key)}"
+                if isinstance(metric, Histogram):
+                    count = sum(value[:-1])
+                    p50 = metric.quantile(value, 0.5)
+                    p95 = metric.quantile(value, 0.95)
+                    lines.append(f"{name}: n={count} avg={value[-1] / count * 1000:.1f}ms "
+                                 f"p50<={p50 * 1000:.0f}ms p95<={p95 * 1000:.0f}ms")
+                else:
+                    lines.append(f"{name}: {value:g}")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+
+def instrument(histogram, errors, **labels):
+    """
+    Decorates a function or coroutine function to record its latency in histogram
+    and count the exceptions it raises in errors.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    errors.inc(**labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - started, **labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+
+    return decorator
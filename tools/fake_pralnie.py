@@ -0,0 +1,225 @@
+"""
+Local stand-in for the three pralnie.org endpoints the bot uses, for load tests and offline development.
+
+Usage: python -m tools.fake_pralnie [--port 8080] [--latency-ms 50] [--error-rate 0.01] [--history 500]
+Then start the bot with PRALNIE_BASE_URL=http://127.0.0.1:8080/index.php
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import random
+import secrets
+import string
+import threading
+import time
+import urllib.parse
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOGIN_PATH = "/index.php/account/login"
+TOPUP_PATH = "/index.php/topUp/createRequest"
+TRANSACTIONS_PATH = "/index.php/accountTransaction/getTransactionList/"
+
+# Name of the Yii identity cookie: md5 of the application id
+IDENTITY_COOKIE = hashlib.md5(b"pralnie-fake").hexdigest()
+COOKIE_LIFETIME = 30 * 86400
+SECRET_KEY = b"fake-pralnie-validation-key"
+
+
+def php_serialize(value) -> str:
+    """Serializes ints, strings and lists the way PHP's serialize() does."""
+    if isinstance(value, int):
+        return f"i:{value};"
+    if isinstance(value, str):
+        return f's:{len(value.encode())}:"{value}";'
+    if isinstance(value, list):
+        items = "".join(f"i:{index};{php_serialize(item)}" for index, item in enumerate(value))
+        return f"a:{len(value)}:{{{items}}}"
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def identity_cookie_value(user_id: int, username: str) -> str:
+    """Builds a Yii 1 identity cookie value: HMAC followed by the serialized identity."""
+    data = php_serialize([str(user_id), username, COOKIE_LIFETIME, []])
+    signature = hmac.new(SECRET_KEY, data.encode(), hashlib.sha1).hexdigest()
+    return urllib.parse.quote(signature + data, safe="")
+
+
+class FakePralnie:
+    """State of the fake service: accounts, sessions and generated transaction histories."""
+
+    def __init__(self, latency_ms=0.0, error_rate=0.0, history=100, session_ttl=None, valid_password=None):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.history = history
+        self.session_ttl = session_ttl
+        self.valid_password = valid_password
+        self.lock = threading.Lock()
+        self.user_ids = {}
+        self.sessions = {}
+        self.histories = {}
+
+    def login(self, username, password):
+        if not username or (self.valid_password is not None and password != self.valid_password):
+            return None
+        with self.lock:
+            user_id = self.user_ids.setdefault(username, 1000 + len(self.user_ids))
+            session_id = "".join(random.choices(string.ascii_lowercase + string.digits, k=26))
+            self.sessions[session_id] = (user_id, time.time())
+        return session_id, user_id
+
+    def session_user(self, cookies):
+        session = self.sessions.get(cookies.get("PHPSESSID"))
+        if session is None:
+            return None
+        user_id, created = session
+        if self.session_ttl is not None and time.time() - created > self.session_ttl:
+            return None
+        return user_id
+
+    def transactions(self, user_id):
+        with self.lock:
+            body = self.histories.get(user_id)
+            if body is None:
+                rng = random.Random(user_id)
+                start = time.time() - self.history * 86400
+                items = []
+                for index in range(self.history):
+                    value = rng.choice([10, 15, 20, 30, 50]) if index % 5 == 0 else -rng.choice([3.5, 4.2, 6])
+                    items.append({
+                        "Id": user_id * 1_000_000 + index,
+                        "Date": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + index * 86400)),
+                        "Value": value,
+                        "Description": "Doładowanie konta" if value > 0 else "Pranie",
+                    })
+                body = self.histories[user_id] = json.dumps(items).encode()
+            return body
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "FakePralnie/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self) -> FakePralnie:
+        return self.server.service
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _cookies(self):
+        cookies = {}
+        for part in self.headers.get("Cookie", "").split(";"):
+            if "=" in part:
+                key, value = part.strip().split("=", 1)
+                cookies[key] = value
+        return cookies
+
+    def _form(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+
+    def _send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate(self):
+        """Sleeps for the configured latency and returns True if this request should fail."""
+        if self.service.latency_ms:
+            time.sleep(random.expovariate(1 / self.service.latency_ms) / 1000)
+        if random.random() < self.service.error_rate:
+            self._send(503, b"Service Unavailable")
+            return True
+        return False
+
+    def _redirect_to_login(self):
+        self._send(302, headers=[("Location", LOGIN_PATH)])
+
+    def do_POST(self):
+        form = self._form()
+        if self._simulate():
+            return
+        if self.path == LOGIN_PATH:
+            username = form.get("LoginForm[username]")
+            result = self.service.login(username, form.get("LoginForm[password]"))
+            if result is None:
+                self._send(200, b"<html>Niepoprawne dane logowania</html>")
+                return
+            session_id, user_id = result
+            expires = formatdate(time.time() + COOKIE_LIFETIME, usegmt=True)
+            self._send(302, headers=[
+                ("Location", "/index.php"),
+                ("Set-Cookie", f"PHPSESSID={session_id}; path=/; HttpOnly"),
+                ("Set-Cookie", f"{IDENTITY_COOKIE}={identity_cookie_value(user_id, username)}; "
+                               f"expires={expires}; Max-Age={COOKIE_LIFETIME}; path=/; HttpOnly"),
+            ])
+        elif self.path == TOPUP_PATH:
+            if self.service.session_user(self._cookies()) is None:
+                self._redirect_to_login()
+                return
+            self._send(302, headers=[("Location", f"https://payments.example/pay/{secrets.token_hex(8)}"
+                                                  f"?amount={form.get('top_up_id')}")])
+        else:
+            self._send(404, b"Not Found")
+
+    def do_GET(self):
+        if self._simulate():
+            return
+        if not self.path.startswith(TRANSACTIONS_PATH):
+            self._send(404, b"Not Found")
+            return
+        user_id = self.service.session_user(self._cookies())
+        if user_id is None:
+            self._redirect_to_login()
+            return
+        if self.path[len(TRANSACTIONS_PATH):] != str(user_id):
+            self._send(403, b"Forbidden")
+            return
+        self._send(200, self.service.transactions(user_id), headers=[("Content-Type", "application/json")])
+
+
+def make_server(host="127.0.0.1", port=0, **options) -> ThreadingHTTPServer:
+    """Creates the fake service; options are passed to FakePralnie."""
+    server = ThreadingHTTPServer((host, port), Handler, bind_and_activate=False)
+    # The default listen backlog of 5 drops connections when many clients log in at once
+    server.request_queue_size = 128
+    server.server_bind()
+    server.server_activate()
+    server.daemon_threads = True
+    server.service = FakePralnie(**options)
+    return server
+
+
+def start_server(host="127.0.0.1", port=0, **options) -> ThreadingHTTPServer:
+    """Starts the fake service in a background thread and returns the server (see server.server_port)."""
+    server = make_server(host, port, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=50, help="mean response latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--history", type=int, default=100, help="transactions per account")
+    parser.add_argument("--session-ttl", type=float, default=None, help="seconds until sessions log out")
+    parser.add_argument("--valid-password", default=None, help="only accept this password")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = make_server(args.host, args.port, latency_ms=args.latency_ms, error_rate=args.error_rate,
+                         history=args.history, session_ttl=args.session_ttl, valid_password=args.valid_password)
+    logging.info(f"Fake pralnie.org listening on http://{args.host}:{args.port}/index.php")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Drives bot/handlers with synthetic Telegram updates for N concurrent users against the fake
+pralnie.org service and reports throughput and latency percentiles per command.
+
+Usage: python -m tools.loadgen [--users 50] [--duration 30] [--latency-ms 50] [--history 200]
+                               [--workers 1] [--base-url http://127.0.0.1:8080/index.php]
+Without --base-url a fake service is started in-process. With --workers N the users are split
+across N processes by chat_id, like the bot's multi-process mode, sharing one database.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+# Share of each command in a user's traffic after logging in
+COMMAND_MIX = {"stan": 0.7, "doladuj": 0.15, "button_callback": 0.15}
+
+
+class FakeMessage:
+    def __init__(self, chat_id, text=""):
+        self.chat_id = chat_id
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeCallbackQuery:
+    def __init__(self, chat_id, data):
+        self.message = FakeMessage(chat_id)
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.message.replies.append(text)
+
+
+class FakeUpdate:
+    def __init__(self, chat_id, text=None, callback_data=None):
+        self.effective_chat = FakeChat(chat_id)
+        self.message = FakeMessage(chat_id, text) if callback_data is None else None
+        self.callback_query = FakeCallbackQuery(chat_id, callback_data) if callback_data is not None else None
+
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def simulate_user(handlers, chat_id, deadline, think_time, latencies, errors):
+    context = FakeContext()
+
+    async def timed(command, coroutine):
+        started = time.perf_counter()
+        try:
+            await coroutine
+        except Exception:
+            errors[command] += 1
+        latencies[command].append(time.perf_counter() - started)
+
+    await timed("start", handlers.start(FakeUpdate(chat_id, "/start"), context))
+    await timed("external_login", handlers.external_login(FakeUpdate(chat_id, f"user{chat_id}"), context))
+    await timed("external_password", handlers.external_password(FakeUpdate(chat_id, "secret"), context))
+
+    commands, weights = zip(*COMMAND_MIX.items())
+    while time.monotonic() < deadline:
+        command = random.choices(commands, weights)[0]
+        if command == "button_callback":
+            update = FakeUpdate(chat_id, callback_data=str(random.randint(1, 5)))
+        else:
+            update = FakeUpdate(chat_id, f"/{command}")
+        await timed(command, getattr(handlers, command)(update, context))
+        if think_time:
+            await asyncio.sleep(random.expovariate(1 / think_time))
+
+
+async def simulate(users, duration, think_time, first_chat_id=10_000):
+    """Simulates users and returns the latencies and errors per command and the elapsed time."""
+    # Imported here so that PRALNIE_BASE_URL and the database file are set up first
+    from bot import handlers
+    from laundry.client import close_client
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        simulate_user(handlers, first_chat_id + n, deadline, think_time, latencies, errors) for n in range(users)
+    ))
+    elapsed = time.perf_counter() - started
+    await close_client()
+    return dict(latencies), dict(errors), elapsed
+
+
+def simulate_in_process(db_file, users, duration, think_time, first_chat_id):
+    """Entry point of a load generating process of --workers."""
+    from database.db import UserDatabase
+    UserDatabase(db_file)
+    return asyncio.run(simulate(users, duration, think_time, first_chat_id))
+
+
+def report(users, workers, results):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    for worker_latencies, worker_errors, _ in results:
+        for command, values in worker_latencies.items():
+            latencies[command].extend(values)
+        for command, count in worker_errors.items():
+            errors[command] += count
+    elapsed = max(result[2] for result in results)
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"{users} users, {workers} workers, {elapsed:.1f} s, {total} updates, {total / elapsed:.1f} updates/s")
+    print(f"{'command':<18}{'count':>8}{'errors':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for command, values in latencies.items():
+        values.sort()
+        print(f"{command:<18}{len(values):>8}{errors[command]:>8}{len(values) / elapsed:>9.1f}"
+              f"{percentile(values, 0.5) * 1000:>9.1f}{percentile(values, 0.95) * 1000:>9.1f}"
+              f"{percentile(values, 0.99) * 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic after logging in")
+    parser.add_argument("--workers", type=int, default=1, help="processes to split the users across")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean pause between a user's commands")
+    parser.add_argument("--base-url", default=None, help="pralnie.org replacement to use instead of an in-process one")
+    parser.add_argument("--latency-ms", type=float, default=50, help="latency of the in-process fake service")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="error rate of the in-process fake service")
+    parser.add_argument("--history", type=int, default=200, help="transactions per account of the fake service")
+    args = parser.parse_args()
+
+    if args.base_url is None:
+        from tools.fake_pralnie import start_server
+        server = start_server(latency_ms=args.latency_ms, error_rate=args.error_rate, history=args.history)
+        args.base_url = f"http://127.0.0.1:{server.server_port}/index.php"
+    os.environ["PRALNIE_BASE_URL"] = args.base_url
+    os.environ.setdefault("METRICS_PORT", "0")
+    # The limits protecting pralnie.org and against spamming chats would otherwise dominate the results
+    os.environ.setdefault("UPSTREAM_MAX_CONCURRENT", "1000")
+    os.environ.setdefault("UPSTREAM_RATE_PER_SECOND", "1000000")
+    os.environ.setdefault("CHAT_RATE_PER_MINUTE", "1000000")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "loadgen.db")
+        from database.db import UserDatabase
+        UserDatabase(db_file)
+        if args.workers == 1:
+            results = [asyncio.run(simulate(args.users, args.duration, args.think_time))]
+        else:
+            # Every process simulates its own chats, as if bot/sharding.py routed them there
+            shards = [(db_file, len(range(w, args.users, args.workers)), args.duration, args.think_time,
+                       10_000 + w * args.users) for w in range(args.workers)]
+            with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+                results = pool.starmap(simulate_in_process, shards)
+        report(args.users, args.workers, results)
+
+
+if __name__ == "__main__":
+    main()